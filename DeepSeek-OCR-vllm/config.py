@@ -1,3 +1,5 @@
+import os
+
 # TODO: change modes
 # Tiny: base_size = 512, image_size = 512, crop_mode = False
 # Small: base_size = 640, image_size = 640, crop_mode = False
@@ -10,6 +12,11 @@ IMAGE_SIZE = 640
 CROP_MODE = True
 MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
+# Views (local tiles / global views) per vision-encoder pass; bounds peak activation memory. 0: no limit.
+ENCODER_MICRO_BATCH = int(os.getenv("ENCODER_MICRO_BATCH", "8"))
+# Elements of the SAM relative-position attention bias built at once (32M = 64MB in bf16); queries are
+# processed in chunks above it. Lower it on small GPUs; 0: always build the full bias.
+ENCODER_ATTN_BIAS_MAX_ELEMENTS = int(os.getenv("ENCODER_ATTN_BIAS_MAX_ELEMENTS", str(1 << 25)))
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers
 PRINT_NUM_VIS_TOKENS = False
@@ -7,6 +7,7 @@ import torch
 from torch.nn import functional as F
 from torch import nn
 from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+from .sam_vary_sdpa import memoized
 # from optimus import flash_attn_func
 # from megatron.core import tensor_parallel
 # from megatron.core import parallel_state as mpu
@@ -128,6 +129,20 @@ class CLIPVisionEmbeddings(nn.Module):
             "position_ids", torch.arange(self.num_positions).expand((1, -1))
         )
 
+        # interpolated position embeddings per (target length, dtype, device)
+        self._pos_cache = {}
+
+    def clear_pos_cache(self):
+        """Drop memoized position embeddings; call after the weights change."""
+        self._pos_cache.clear()
+
+    def get_pos_embed(self, tgt_size):
+        weight = self.position_embedding.weight
+        key = (tgt_size, weight.dtype, weight.device)
+        return memoized(
+            self._pos_cache, key, lambda: get_abs_pos(self.position_embedding(self.position_ids), tgt_size)
+        )
+
     def forward(self, pixel_values, patch_embeds):
         batch_size = pixel_values.shape[0]
         # patch_embeds = self.patch_embedding(
@@ -151,7 +166,7 @@ class CLIPVisionEmbeddings(nn.Module):
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
 
         # x = torch.cat([cls_token, x], dim=1)
-        embeddings = embeddings + get_abs_pos(self.position_embedding(self.position_ids), embeddings.size(1))
+        embeddings = embeddings + self.get_pos_embed(embeddings.size(1))
         # embeddings = embeddings + self.position_embedding(self.position_ids)
         return embeddings
 
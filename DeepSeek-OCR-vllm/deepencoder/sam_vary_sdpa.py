@@ -15,6 +15,11 @@ from flash_attn import flash_attn_qkvpacked_func
 
 # from mmgpt.model.vision_encoder.flash_4 import _attention_rel_h_rel_w
 
+# Default upper bound on the elements of the (B, nHead, q_len, k_len) relative position bias built
+# at once by rel_pos_attention (32M elements = 64MB in bf16); <= 0 always builds the full bias.
+# Overridden per model through build_sam_vit_b(attn_bias_max_elements=...).
+ATTN_BIAS_MAX_ELEMENTS = 1 << 25
+
 
 def get_abs_pos(abs_pos, tgt_size):
 
@@ -38,6 +43,20 @@ def get_abs_pos(abs_pos, tgt_size):
         return abs_pos
 
 
+def memoized(cache: dict, key, compute):
+    """
+    Return cache[key], computing it on first use. Positional tables depend only on the
+    weights and the target size, so at inference they are built once per size instead of
+    on every forward. Bypassed while autograd is enabled so training still sees fresh graphs.
+    """
+    if torch.is_grad_enabled():
+        return compute()
+    value = cache.get(key)
+    if value is None:
+        value = cache[key] = compute()
+    return value
+
+
 
 
 class MLPBlock(nn.Module):
@@ -93,6 +112,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_bias_max_elements: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -111,6 +131,8 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_bias_max_elements (int or None): Relative position bias elements built at once
+                in attention, see rel_pos_attention. None uses ATTN_BIAS_MAX_ELEMENTS.
         """
         super().__init__()
         self.img_size = img_size
@@ -142,6 +164,7 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_bias_max_elements=attn_bias_max_elements,
             )
             self.blocks.append(block)
 
@@ -166,11 +189,20 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # interpolated pos_embed per (target size, dtype, device)
+        self._pos_cache = {}
+
+    def clear_pos_cache(self) -> None:
+        """Drop memoized positional tables; call after the weights change."""
+        self._pos_cache.clear()
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             # x = x + self.pos_embed
-            x = x + get_abs_pos(self.pos_embed, x.size(1))
+            tgt_size = x.size(1)
+            key = (tgt_size, self.pos_embed.dtype, self.pos_embed.device)
+            x = x + memoized(self._pos_cache, key, lambda: get_abs_pos(self.pos_embed, tgt_size))
 
         for blk in self.blocks:
             x = blk(x)
@@ -198,6 +230,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_bias_max_elements: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -213,6 +246,8 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_bias_max_elements (int or None): Relative position bias elements built at once
+                in attention, see rel_pos_attention.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -223,6 +258,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attn_bias_max_elements=attn_bias_max_elements,
         )
 
         self.norm2 = norm_layer(dim)
@@ -260,6 +296,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_bias_max_elements: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -270,9 +307,12 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_bias_max_elements (int or None): Relative position bias elements built at once,
+                see rel_pos_attention.
         """
         super().__init__()
         self.num_heads = num_heads
+        self.attn_bias_max_elements = attn_bias_max_elements
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
 
@@ -288,6 +328,23 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # (Rh, Rw) per (q_size, k_size, dtype, device)
+        self._pos_cache = {}
+
+    def clear_pos_cache(self) -> None:
+        """Drop memoized positional tables; call after the weights change."""
+        self._pos_cache.clear()
+
+    def get_rel_pos_hw(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Relative positional embeddings for the height and width axes, see get_rel_pos."""
+        key = (q_size, k_size, self.rel_pos_h.dtype, self.rel_pos_h.device)
+        return memoized(self._pos_cache, key, lambda: (
+            get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+            get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+        ))
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -297,7 +354,8 @@ class Attention(nn.Module):
 
         rel_h, rel_w = None, None
         if self.use_rel_pos:
-            rel_h, rel_w = add_decomposed_rel_pos(q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            Rh, Rw = self.get_rel_pos_hw((H, W), (H, W))
+            rel_h, rel_w = decomposed_rel_pos(q, Rh, Rw, (H, W), (H, W))
 
         q = q.view(B, self.num_heads, H * W, -1)
         k = k.view(B, self.num_heads, H * W, -1)
@@ -306,8 +364,7 @@ class Attention(nn.Module):
         if self.use_rel_pos:
             rel_h = rel_h.view(B, self.num_heads, rel_h.size(1), rel_h.size(2), rel_h.size(3))
             rel_w = rel_w.view(B, self.num_heads, rel_w.size(1), rel_w.size(2), rel_w.size(3))
-            attn_bias = (rel_h + rel_w).view(B, self.num_heads, rel_h.size(2), rel_h.size(3) * rel_w.size(4))
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+            x = rel_pos_attention(q, k, v, rel_h, rel_w, self.attn_bias_max_elements)
             # x = _attention_rel_h_rel_w(q, k, v, rel_h, rel_w)
         else:
             x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
@@ -323,6 +380,52 @@ class Attention(nn.Module):
         return x
 
 
+def rel_pos_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    rel_h: torch.Tensor,
+    rel_w: torch.Tensor,
+    max_bias_elements: int = None,
+) -> torch.Tensor:
+    """
+    scaled_dot_product_attention with the decomposed relative position bias rel_h + rel_w.
+    The dense bias grows with B * (H * W)^2, so when it would exceed max_bias_elements the
+    queries are processed in chunks and only the bias rows of the current chunk are built.
+    Attention rows are independent, so chunking does not change the result.
+    Args:
+        q, k, v (Tensor): (B, nHead, q_h * q_w, C) queries, keys and values.
+        rel_h (Tensor): (B, nHead, q_h * q_w, k_h, 1) height bias from decomposed_rel_pos.
+        rel_w (Tensor): (B, nHead, q_h * q_w, 1, k_w) width bias from decomposed_rel_pos.
+        max_bias_elements (int or None): bias elements per chunk, ATTN_BIAS_MAX_ELEMENTS by default.
+
+    Returns:
+        x (Tensor): attention output with shape (B, nHead, q_h * q_w, C).
+    """
+    if max_bias_elements is None:
+        max_bias_elements = ATTN_BIAS_MAX_ELEMENTS
+    B, num_heads, q_len, k_h, _ = rel_h.shape
+    k_len = k_h * rel_w.size(4)
+
+    chunk = max(1, max_bias_elements // (B * num_heads * k_len)) if max_bias_elements > 0 else q_len
+    if chunk >= q_len:
+        attn_bias = (rel_h + rel_w).view(B, num_heads, q_len, k_len)
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+
+    # keep chunks aligned to the 128-row query blocks of the fused SDPA kernels
+    if chunk > 128:
+        chunk -= chunk % 128
+
+    x = q.new_empty(B, num_heads, q_len, v.size(-1))
+    for start in range(0, q_len, chunk):
+        end = min(start + chunk, q_len)
+        attn_bias = (rel_h[:, :, start:end] + rel_w[:, :, start:end]).view(B, num_heads, end - start, k_len)
+        x[:, :, start:end] = torch.nn.functional.scaled_dot_product_attention(
+            q[:, :, start:end], k, v, attn_mask=attn_bias
+        )
+    return x
+
+
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
     Partition into non-overlapping windows with padding if needed.
@@ -427,10 +530,33 @@ def add_decomposed_rel_pos(
     Returns:
         attn (Tensor): attention map with added relative positional embeddings.
     """
+    Rh = get_rel_pos(q_size[0], k_size[0], rel_pos_h)
+    Rw = get_rel_pos(q_size[1], k_size[1], rel_pos_w)
+    return decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
+
+
+def decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    add_decomposed_rel_pos with the positional embeddings already extracted by get_rel_pos.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): relative position embeddings (q_h, k_h, C) for height axis.
+        Rw (Tensor): relative position embeddings (q_w, k_w, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        rel_h (Tensor): height bias with shape (B, q_h * q_w, k_h, 1).
+        rel_w (Tensor): width bias with shape (B, q_h * q_w, 1, k_w).
+    """
     q_h, q_w = q_size
     k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
 
     B, _, dim = q.shape
     r_q = q.reshape(B, q_h, q_w, dim)
@@ -478,13 +604,14 @@ class PatchEmbed(nn.Module):
         return x
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, attn_bias_max_elements=None):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        attn_bias_max_elements=attn_bias_max_elements,
     )
 
 
@@ -494,6 +621,7 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    attn_bias_max_elements=None,
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -512,6 +640,7 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            attn_bias_max_elements=attn_bias_max_elements,
         )
     
     if checkpoint is not None:
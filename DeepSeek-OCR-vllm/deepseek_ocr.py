@@ -28,7 +28,7 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, ResolutionProfile, RESOLUTION_PROFILE_FIELDS, count_image_tokens)
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -42,7 +42,7 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT, ENCODER_MICRO_BATCH, ENCODER_ATTN_BIAS_MAX_ELEMENTS
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -53,6 +53,8 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
         return self.ctx.get_hf_config(DeepseekVLV2Config)
 
     def get_hf_processor(self, **kwargs: object):
+        # resolution kwargs are per-request preprocessing settings, not processor init args
+        kwargs = {k: v for k, v in kwargs.items() if k not in RESOLUTION_PROFILE_FIELDS}
         return self.ctx.get_hf_processor(DeepseekOCRProcessor, **kwargs)
 
     def get_supported_mm_limits(self) -> Mapping[str, Optional[int]]:
@@ -62,48 +64,13 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              *,
                              image_width: int,
                              image_height: int,
-                             cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+                             cropping: bool = True,
+                             profile: Optional[ResolutionProfile] = None) -> int:
+        # per-request profile from the mm processor kwargs, otherwise the global config
+        if profile is None:
+            profile = ResolutionProfile(base_size=BASE_SIZE, image_size=IMAGE_SIZE, crop_mode=CROP_MODE)
+        # memoized per image size, shared with the processor's tiling tables
+        return count_image_tokens(image_width, image_height, profile)
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -198,6 +165,9 @@ class DeepseekOCRMultiModalProcessor(
         image_token_id = hf_processor.image_token_id
         assert isinstance(image_token_id, int)
 
+        # resolution / crop settings the images were preprocessed with
+        profile = ResolutionProfile.from_kwargs(hf_processor_mm_kwargs)
+
         def get_replacement_deepseek_vl2(item_idx: int):
             images = mm_items.get_items(
                 "image", (ImageEmbeddingItems, ImageProcessorItems))
@@ -216,7 +186,8 @@ class DeepseekOCRMultiModalProcessor(
                     image_width=width,
                     image_height=height,
                     # flag = True,
-                    cropping=CROP_MODE,
+                    cropping=profile.crop_mode,
+                    profile=profile,
                 )
             return [image_token_id] * num_image_tokens
 
@@ -285,7 +256,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         tokenizer = cached_tokenizer_from_config(model_config)
         self.image_token_id = tokenizer.vocab[_IMAGE_TOKEN]
 
-        self.sam_model = build_sam_vit_b()
+        self.sam_model = build_sam_vit_b(attn_bias_max_elements=ENCODER_ATTN_BIAS_MAX_ELEMENTS)
         self.vision_model = build_clip_l()
 
         n_embed = 1280
@@ -338,7 +309,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         images_crop = kwargs.pop("images_crop", None)
 
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        if pixel_values is None:
             return None
 
         if pixel_values is not None:
@@ -354,80 +325,109 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            # Tile grids as host ints: [n_image, batch_size, 2] -> [(num_tiles_w, num_tiles_h), ...].
+            # One small copy per batch drives the crop / no-crop branches, instead of reducing
+            # the pixel tensors on the device (and syncing) for every image. The processor's
+            # placeholder for "no image" has zero grids.
+            if isinstance(images_spatial_crop, torch.Tensor):
+                images_spatial_crop = images_spatial_crop.tolist()
+            else:
+                images_spatial_crop = [crop.tolist() for crop in images_spatial_crop]
+            tile_grids = [tuple(crop[0]) for crop in images_spatial_crop]
+            if not any(any(grid) for grid in tile_grids):
+                return None
+
+            return [pixel_values, images_crop, tile_grids]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        """SAM + CLIP + projector over a batch of same-sized views: [N, 3, H, W] -> [N, hw, n_embed]
+
+        At most ENCODER_MICRO_BATCH views go through the encoder at once, so peak activation
+        memory is bounded by the micro-batch instead of the number of tiles in the batch.
+        """
+        if 0 < ENCODER_MICRO_BATCH < views.size(0):
+            return torch.cat([self._encode_views(chunk) for chunk in views.split(ENCODER_MICRO_BATCH)], dim=0)
+
+        features_1 = self.sam_model(views)
+        features_2 = self.vision_model(views, features_1)
+        features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
     def _pixel_values_to_embedding(
         self,
-        pixel_values: torch.Tensor,
-        images_crop: torch.Tensor,
-        images_spatial_crop: torch.Tensor,
+        pixel_values: NestedTensors,
+        images_crop: NestedTensors,
+        tile_grids: List[Tuple[int, int]],
     ) -> NestedTensors:
 
         # Pixel_values (global view): [n_image, batch_size, 3, height, width]
-        # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
+        # tile_grids: [n_image, (num_tiles_w, num_tiles_h)] (host ints)
         # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
         # split the pixel and image_crop, all batch_size = 1
+        # pixel_values / images_crop are lists when the images in the batch have different sizes
 
-        images_in_this_batch = []
-
-
-        # print(type(images_crop))
+        num_images = len(tile_grids)
 
-        # print(pixel_values.shape)
+        # Group the views of all images in the batch by size and run each group
+        # through the encoder in one pass: global views per base size, local tiles
+        # per tile size (the tiles of one image stay contiguous).
+        global_groups, local_groups = {}, {}
+        for jdx in range(num_images):
+            global_groups.setdefault(tuple(pixel_values[jdx].shape[-2:]), []).append(jdx)
+            patches = images_crop[jdx][0]
+            num_width_tiles, num_height_tiles = tile_grids[jdx]
+            # same rule as the processor: only multi-tile grids carry local views
+            if num_width_tiles > 1 or num_height_tiles > 1:
+                local_groups.setdefault(tuple(patches.shape[-2:]), []).append(jdx)
 
+        global_features_list = [None] * num_images
+        local_features_list = [None] * num_images
 
         with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
-
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
-
-
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('PATCHES: ', local_features.shape)
-                        print('=====================')
+            for indices in global_groups.values():
+                views = torch.cat([pixel_values[jdx] for jdx in indices], dim=0).to(torch.bfloat16)
+                for jdx, features in zip(indices, self._encode_views(views)):
+                    global_features_list[jdx] = features
+
+            for indices in local_groups.values():
+                tiles = [images_crop[jdx][0] for jdx in indices]
+                views = torch.cat(tiles, dim=0).to(torch.bfloat16)
+                features = self._encode_views(views).split([t.size(0) for t in tiles], dim=0)
+                for jdx, local_features in zip(indices, features):
+                    local_features_list[jdx] = local_features
+
+            images_in_this_batch = []
+            for jdx in range(num_images):
+                global_features = global_features_list[jdx]
+                local_features = local_features_list[jdx]
+
+                if PRINT_NUM_VIS_TOKENS:
+                    print('=====================')
+                    print('BASE: ', global_features.shape)
+                    print('PATCHES: ', local_features.shape if local_features is not None else 'NO PATCHES')
+                    print('=====================')
+
+                hw, n_dim = global_features.shape
+                h = w = int(hw ** 0.5)
+
+                global_features = global_features.view(h, w, n_dim)
+
+                global_features = torch.cat(
+                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+                )
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
+                global_features = global_features.view(-1, n_dim)
 
+                if local_features is not None:
                     _2, hw2, n_dim2 = local_features.shape
                     h2 = w2 = int(hw2 ** 0.5)
 
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
+                    width_crop_num, height_crop_num = tile_grids[jdx]
 
                     local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
                     local_features = torch.cat(
@@ -436,30 +436,8 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     local_features = local_features.view(-1, n_dim2)
 
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('NO PATCHES')
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
 
+                else:
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
                 images_in_this_batch.append(global_local_features)
@@ -470,9 +448,10 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        # image_input: [pixel_values, images_crop, tile_grids]
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        # converted to bfloat16 per encoder group (a list when the image sizes differ)
+        pixel_values = image_input[0]
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -480,11 +459,11 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop = image_input[1].to(torch.bfloat16)
         images_crop = image_input[1]
         # images_crop = image_input[1]
-        images_spatial_crop = image_input[2].to(dtype=torch.long)
+        tile_grids = image_input[2]
 
         # local_start = time.time()
         vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
+            pixel_values=pixel_values, images_crop = images_crop,  tile_grids=tile_grids)
 
         # local_total_time = time.time() - local_start
 
@@ -575,6 +554,11 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         loader = AutoWeightsLoader(self)
         autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
 
+        # interpolated positional embeddings memoized by the encoders were built from the old weights
+        for module in self.modules():
+            if hasattr(module, "clear_pos_cache"):
+                module.clear_pos_cache()
+
 
 
 
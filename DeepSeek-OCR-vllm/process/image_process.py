@@ -1,6 +1,9 @@
 import math
-from typing import List, Tuple
+from dataclasses import asdict, dataclass, fields
+from functools import lru_cache
+from typing import List, Mapping, Optional, Tuple
 
+import numpy as np
 import torch
 import torchvision.transforms as T
 from PIL import Image, ImageOps
@@ -8,6 +11,34 @@ from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
 from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
 
+@dataclass(frozen=True)
+class ResolutionProfile:
+    """Immutable preprocessing settings for one request.
+
+    Passed to tokenize_with_images instead of changing the processor's attributes,
+    so a single processor (or any number of worker processes) can serve requests
+    with different resolutions concurrently.
+    """
+    base_size: int = BASE_SIZE
+    image_size: int = IMAGE_SIZE
+    crop_mode: bool = CROP_MODE
+    min_crops: int = MIN_CROPS
+    max_crops: int = MAX_CROPS
+
+    @classmethod
+    def from_kwargs(cls, kwargs: Mapping[str, object]) -> "ResolutionProfile":
+        """Build a profile from mm processor kwargs; missing fields use the global config."""
+        return cls(**{name: kwargs[name] for name in RESOLUTION_PROFILE_FIELDS if name in kwargs})
+
+    def to_kwargs(self) -> dict:
+        """The profile as mm processor kwargs (the inverse of from_kwargs)."""
+        return asdict(self)
+
+
+# mm processor kwargs that carry a ResolutionProfile through vLLM
+RESOLUTION_PROFILE_FIELDS = tuple(field.name for field in fields(ResolutionProfile))
+
+
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
     best_ratio = (1, 1)
@@ -25,46 +56,85 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
+@lru_cache(maxsize=None)
+def get_target_ratios(min_num, max_num, image_size):
+    """Candidate tile grids for a crop range, computed once.
 
-    # calculate the existing image aspect ratio
+    Returns (ratio, aspect, area_threshold) entries in the order find_closest_aspect_ratio
+    scans them, with the per-ratio terms it evaluates precomputed (same expressions,
+    so the comparisons are exact).
+    """
     target_ratios = set(
         (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
         i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
     target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return tuple(
+        (ratio, ratio[0] / ratio[1], 0.5 * image_size * image_size * ratio[0] * ratio[1])
+        for ratio in target_ratios)
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
 
-    return target_aspect_ratio
+@lru_cache(maxsize=4096)
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    """Tile grid (width_tiles, height_tiles) for an image size, memoized per size."""
+    aspect_ratio = orig_width / orig_height
+    area = orig_width * orig_height
 
+    # find the closest aspect ratio to the target (same scan as find_closest_aspect_ratio)
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    for ratio, target_aspect_ratio, area_threshold in get_target_ratios(min_num, max_num, image_size):
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > area_threshold:
+                best_ratio = ratio
+    return best_ratio
 
-def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+@lru_cache(maxsize=4096)
+def count_image_tokens(image_width, image_height, profile=ResolutionProfile(), patch_size=16, downsample_ratio=4):
+    """Number of vision tokens tokenize_with_images emits for an image size, memoized per size."""
+    if profile.crop_mode and (image_width > 640 or image_height > 640):
+        num_width_tiles, num_height_tiles = count_tiles(
+            image_width, image_height, profile.min_crops, profile.max_crops, profile.image_size)
+    else:
+        num_width_tiles = num_height_tiles = 1
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    num_queries = math.ceil((profile.image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((profile.base_size // patch_size) / downsample_ratio)
+
+    global_views_tokens = num_queries_base * (num_queries_base + 1)
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        local_views_tokens = (num_height_tiles * num_queries) * (num_width_tiles * num_queries + 1)
+    else:
+        local_views_tokens = 0
+    return global_views_tokens + local_views_tokens + 1
+
+
+def resize_to_tiles(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640):
+    """Resize the image to exactly cover its best tile grid.
+
+    Returns the resized image and the (width_tiles, height_tiles) grid.
+    """
+    orig_width, orig_height = image.size
+    target_aspect_ratio = count_tiles(orig_width, orig_height, min_num, max_num, image_size)
 
-    # print(target_aspect_ratio)
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
     target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
 
     # resize the image
     resized_img = image.resize((target_width, target_height))
+    return resized_img, target_aspect_ratio
+
+
+def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    resized_img, target_aspect_ratio = resize_to_tiles(image, min_num, max_num, image_size)
+    target_width, target_height = resized_img.size
+    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
+
     processed_images = []
     for i in range(blocks):
         box = (
@@ -107,6 +177,28 @@ class ImageTransform:
         x = self.transform(pil_img)
         return x
 
+    def tiles(self, pil_img: Image.Image, tile_size: int) -> torch.Tensor:
+        """Split the image into tiles and transform them in one pass.
+
+        Returns [num_tiles, C, tile_size, tile_size] in row-major tile order, bit-identical
+        to transforming each `pil_img.crop(box)` separately, but without creating a PIL
+        image per crop: the uint8 pixels are rearranged into tile order first, then
+        converted and normalized in place.
+        """
+        width, height = pil_img.size
+        rows, cols = height // tile_size, width // tile_size
+        pixels = torch.from_numpy(np.array(pil_img, dtype=np.uint8)).view(height, width, -1)
+        x = pixels.view(rows, tile_size, cols, tile_size, -1).permute(0, 2, 4, 1, 3)
+        x = x.reshape(rows * cols, -1, tile_size, tile_size)
+
+        # same operations as ToTensor + Normalize
+        x = x.to(torch.float32).div_(255)
+        if self.normalize:
+            mean = torch.as_tensor(self.mean, dtype=x.dtype).view(1, -1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=x.dtype).view(1, -1, 1, 1)
+            x.sub_(mean).div_(std)
+        return x
+
 
 class DeepseekOCRProcessor(ProcessorMixin):
     tokenizer_class = ("LlamaTokenizer", "LlamaTokenizerFast")
@@ -327,6 +419,70 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return prepare
 
+    def build_token_template(
+        self,
+        conversation: str,
+        base_size: int,
+        image_size: int,
+        image_grids: Tuple[Tuple[int, int], ...],
+        bos: bool = True,
+        eos: bool = True,
+    ):
+        """Build input_ids, images_seq_mask and num_image_tokens for a prompt.
+
+        The image-token runs only depend on the sizes and on each image's
+        (width_tiles, height_tiles) grid, so the result can be cached and reused
+        for every image with the same layout (see `_token_template`). Inference
+        only: the ending eos token is removed and no target_ids are built.
+        """
+        text_splits = conversation.split(self.image_token)
+        tokenized_str, images_seq_mask, num_image_tokens = [], [], []
+        for text_sep, (num_width_tiles, num_height_tiles) in zip(text_splits, image_grids):
+            """encode text_sep"""
+            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
+            tokenized_str += tokenized_sep
+            images_seq_mask += [False] * len(tokenized_sep)
+
+            """add image tokens"""
+            num_queries = math.ceil((image_size // self.patch_size) / self.downsample_ratio)
+            num_queries_base = math.ceil((base_size // self.patch_size) / self.downsample_ratio)
+
+            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
+            tokenized_image += [self.image_token_id]
+            if num_width_tiles > 1 or num_height_tiles > 1:
+                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
+                            num_queries * num_height_tiles)
+            tokenized_str += tokenized_image
+            images_seq_mask += [True] * len(tokenized_image)
+            num_image_tokens.append(len(tokenized_image))
+
+        """process the last text split"""
+        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
+        tokenized_str += tokenized_sep
+        images_seq_mask += [False] * len(tokenized_sep)
+
+        """add the bos and eos tokens"""
+        if bos:
+            tokenized_str = [self.bos_id] + tokenized_str
+            images_seq_mask = [False] + images_seq_mask
+        if eos:
+            tokenized_str = tokenized_str + [self.eos_id]
+            images_seq_mask = images_seq_mask + [False]
+
+        assert len(tokenized_str) == len(
+            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
+
+        input_ids = torch.LongTensor(tokenized_str)
+        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
+        input_ids[input_ids < 0] = self.pad_id
+
+        # Remove the ending eos token
+        assert input_ids[-1] == self.eos_id
+        input_ids = input_ids[:-1]
+        images_seq_mask = images_seq_mask[:-1]
+
+        return input_ids, images_seq_mask, tuple(num_image_tokens)
+
     def tokenize_with_images(
         self,
         # conversation: str,
@@ -334,24 +490,28 @@ class DeepseekOCRProcessor(ProcessorMixin):
         bos: bool = True,
         eos: bool = True,
         cropping: bool = True,
+        profile: Optional[ResolutionProfile] = None,
+        conversation: Optional[str] = None,
     ):
-        """Tokenize text with <image> tags."""
+        """Tokenize text with <image> tags.
+
+        `profile` carries the per-request sizes and crop settings; without it the
+        processor's image_size / base_size and `cropping` are used. The processor
+        itself is never modified. `conversation` is the request prompt (defaults
+        to the config PROMPT).
+        """
+        if profile is None:
+            profile = ResolutionProfile(base_size=self.base_size, image_size=self.image_size, crop_mode=cropping)
+        cropping = profile.crop_mode
 
         # print(conversation)
-        conversation = PROMPT
+        if conversation is None:
+            conversation = PROMPT
         assert conversation.count(self.image_token) == len(images)
-        text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
+        images_list, images_crop_list, images_spatial_crop = [], [], []
         image_shapes = []
-        num_image_tokens = []
-        tokenized_str = []
         # print('image: ', len(images))
-        for text_sep, image in zip(text_splits, images):
-            """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
-
+        for image in images:
             """select best resolution for anyres"""
             # if cropping:
             #     best_width, best_height = self.select_best_resolution(image.size)
@@ -368,7 +528,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
                     # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
                     # print('image ', image.size)
                     # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
+                    resized_img, crop_ratio = resize_to_tiles(
+                        image, profile.min_crops, profile.max_crops, profile.image_size)
                     # print('crop_ratio: ', crop_ratio)
                 else:
                     # best_width, best_height = self.image_size, self.image_size
@@ -379,11 +540,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
             """process the global view"""
 
             # if cropping
-            if self.image_size <= 640 and not cropping:
+            if profile.image_size <= 640 and not cropping:
                 # print('directly resize')
-                image = image.resize((self.image_size, self.image_size))
+                image = image.resize((profile.image_size, profile.image_size))
 
-            global_view = ImageOps.pad(image, (self.base_size, self.base_size),
+            global_view = ImageOps.pad(image, (profile.base_size, profile.base_size),
                                     color=tuple(int(x * 255) for x in self.image_transform.mean))
             images_list.append(self.image_transform(global_view))
 
@@ -403,8 +564,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
                 #     for j in range(0, best_width, self.image_size):
                 #         images_crop_list.append(
                 #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-                for i in range(len(images_crop_raw)):
-                    images_crop_list.append(self.image_transform(images_crop_raw[i]))
+                # transform all tiles of the resized image at once
+                images_crop_list.append(self.image_transform.tiles(resized_img, profile.image_size))
 
             # """process the global view"""
             # global_view = ImageOps.pad(image, (self.image_size, self.image_size),
@@ -419,79 +580,29 @@ class DeepseekOCRProcessor(ProcessorMixin):
             #         images_list.append(
             #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
 
-            # """add image tokens"""
-            """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
-
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
-            num_image_tokens.append(len(tokenized_image))
-
-        """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos and eos tokens"""
-        if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
-        if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
-
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
-            else:
-                masked_tokenized_str.append(self.ignore_id)
-
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
-
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
-
-        # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
-        target_ids[(input_ids < 0) |
-                   (input_ids == self.image_token_id)] = self.ignore_id
-        input_ids[input_ids < 0] = self.pad_id
-
-        inference_mode = True
-
-        if inference_mode:
-            # Remove the ending eos token
-            assert input_ids[-1] == self.eos_id
-            input_ids = input_ids[:-1]
-            target_ids = target_ids[:-1]
-            images_seq_mask = images_seq_mask[:-1]
+        """add the text and image tokens"""
+        # input_ids / images_seq_mask only depend on the prompt, the sizes and the tile grids
+        input_ids, images_seq_mask, num_image_tokens = _token_template(
+            self, conversation, profile.base_size, profile.image_size,
+            tuple(tuple(crop) for crop in images_spatial_crop), bos, eos)
+        input_ids = input_ids.clone()
+        images_seq_mask = images_seq_mask.clone()
+        num_image_tokens = list(num_image_tokens)
 
         if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
+            pixel_values = torch.zeros((1, 3, profile.base_size, profile.base_size))
             images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            images_crop = torch.zeros((1, 3, profile.image_size, profile.image_size)).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
             if images_crop_list:
-                images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
+                if len(images_crop_list) == 1:
+                    images_crop = images_crop_list[0].unsqueeze(0)
+                else:
+                    images_crop = torch.cat(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.zeros((1, 3, profile.image_size, profile.image_size)).unsqueeze(0)
 
         input_ids = input_ids.unsqueeze(0)
 
@@ -499,4 +610,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
         return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
 
 
+@lru_cache(maxsize=256)
+def _token_template(processor, conversation, base_size, image_size, image_grids, bos, eos):
+    """Cached DeepseekOCRProcessor.build_token_template (returned tensors are shared, clone before use)."""
+    return processor.build_token_template(conversation, base_size, image_size, image_grids, bos, eos)
+
+
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
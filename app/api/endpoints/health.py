@@ -6,6 +6,8 @@ from fastapi import HTTPException
 from fastapi.responses import HTMLResponse
 
 from app.core.lifespan import get_engine
+from app.services.cache_service import result_cache
+from app.services.scheduler import ocr_scheduler
 from app.utils.templates import load_template
 
 logger = logging.getLogger(__name__)
@@ -21,6 +23,8 @@ async def health_check():
         "status": "healthy",
         "model": "DeepSeek-OCR",
         "version": "1.0.0",
+        "cache": result_cache.stats() if result_cache is not None else None,
+        "scheduler": ocr_scheduler.stats(),
     }
 
 
@@ -5,37 +5,51 @@ import uuid
 import time
 import logging
 import asyncio
-import os
-from typing import Optional
+import zipfile
+from typing import Dict, List, Optional
 from pathlib import Path
-from fastapi import UploadFile, File, Form, HTTPException, BackgroundTasks
+from contextlib import aclosing
+from fastapi import UploadFile, File, Form, HTTPException, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
 
-from app.models.schemas import OCRResponse, TaskStatus
-from app.services.ocr_service import process_ocr_task
+from app.models.schemas import (
+    OCRResponse, TaskStatus, TaskListResponse, OCRBatchItemResult, OCRBatchResponse
+)
+from app.services.ocr_service import process_ocr_task, estimate_vision_tokens, DEFAULT_IMAGE_SIZE
+from app.services.task_registry import task_registry, FINISHED_STATUSES
+from app.services.cache_service import raw_pixels_digest
+from app.services.webhook_service import validate_callback_url, schedule_webhook
+from app.services.scheduler import Priority, Backlog, bind_job_context, ocr_scheduler
+from app.utils.image_utils import read_image_size, PIXEL_FORMATS
+from app.services.batch_service import collect_batch_items, iter_batch_results, is_zip_upload
+from app.utils.disconnect import run_until_disconnected
+from app.core.tracing import Trace, span, current_trace
+from app.utils.upload_utils import (
+    save_upload, spool_upload, check_upload_size, mapped_upload, read_request_body
+)
+from app.utils.streaming import (
+    ocr_sse_events, format_sse, format_ndjson, SSE_MEDIA_TYPE, NDJSON_MEDIA_TYPE, STREAMING_HEADERS
+)
 from app.core.config import (
-    UPLOAD_DIR, ALLOWED_EXTENSIONS, RESOLUTION_CONFIGS, TASK_PROMPTS, MAX_CONCURRENCY
+    UPLOAD_DIR, ALLOWED_EXTENSIONS, RESOLUTION_CONFIGS, TASK_PROMPTS,
+    MAX_FILE_SIZE, MAX_RAW_IMAGE_SIZE, MAX_DOCUMENT_SIZE, TASK_LIST_MAX_LIMIT,
+    TASK_MAX_WAIT, TASK_EVENTS_KEEPALIVE
 )
 
 logger = logging.getLogger(__name__)
 
-# 任务存储（生产环境应使用Redis等）
-tasks = {}
-
-# 并发控制：限制同时执行的OCR任务数量
-# 默认使用配置中的 MAX_CONCURRENCY，但考虑到GPU内存限制，建议设置为1-4
-# 这个信号量确保不会同时处理过多任务导致GPU内存溢出
-MAX_CONCURRENT_OCR_TASKS = int(os.getenv("MAX_CONCURRENT_OCR_TASKS", str(min(MAX_CONCURRENCY, 3))))
-task_semaphore = asyncio.Semaphore(MAX_CONCURRENT_OCR_TASKS)
-
-logger.info(f"OCR任务并发控制：最多同时执行 {MAX_CONCURRENT_OCR_TASKS} 个任务")
+# 本进程中排队或执行中的 /api/ocr 任务，DELETE /api/tasks/{task_id} 通过它取消
+_running_tasks: Dict[str, asyncio.Task] = {}
 
 
 async def upload_and_process(
+    request: Request,
     file: UploadFile = File(...),
     include_visualization: bool = Form(True),
     resolution: str = Form("gundam"),
     task_type: str = Form("markdown"),
     reference_text: Optional[str] = Form(None),
+    callback_url: Optional[str] = Form(None),
     background_tasks: BackgroundTasks = BackgroundTasks()
 ):
     """上传图片并进行OCR处理
@@ -46,7 +60,8 @@ async def upload_and_process(
     3. 将处理函数添加到 FastAPI 的 BackgroundTasks 队列
     4. 立即返回任务ID，不等待处理完成
     5. FastAPI 在响应返回后自动执行后台任务
-    6. 客户端通过 /api/tasks/{task_id} 轮询任务状态
+    6. 客户端通过 /api/tasks/{task_id}?wait=30 长轮询或 /api/tasks/{task_id}/events 订阅任务状态，
+       或提供 callback_url，任务结束后由服务端 POST 任务状态
     
     注意：BackgroundTasks 在响应返回后执行，适合短时间任务。
     生产环境建议使用 Redis + Celery 实现真正的任务队列。
@@ -64,32 +79,53 @@ async def upload_and_process(
     # 检查任务类型
     if task_type not in TASK_PROMPTS and not task_type.startswith("<"):
         raise HTTPException(status_code=400, detail=f"不支持的任务类型: {task_type}")
+
+    # 检查回调地址
+    if callback_url:
+        try:
+            # 会解析主机名（DNS），在线程中执行
+            await asyncio.to_thread(validate_callback_url, callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    # 生成任务ID
+    # 生成任务ID，任务按 normal 优先级调度
     task_id = str(uuid.uuid4())
+    bind_job_context(request, Priority.NORMAL, job_id=task_id)
     
     # 保存上传的文件
     upload_path = UPLOAD_DIR / f"{task_id}{file_ext}"
-    with open(upload_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    await save_upload(file, upload_path, MAX_FILE_SIZE)
+
+    # 准入控制：按图片的视觉 token 成本估算排队时间，过长时返回 429（只读取图片头）
+    try:
+        width, height = await asyncio.to_thread(read_image_size, upload_path)
+        cost = estimate_vision_tokens(width, height, resolution)
+        ocr_scheduler.admit(cost)
+    except HTTPException:
+        upload_path.unlink(missing_ok=True)
+        raise
+    except Exception as e:
+        upload_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=f"无法识别的图片: {str(e)}")
     
     # 创建任务
-    tasks[task_id] = TaskStatus(
+    await task_registry.create(TaskStatus(
         task_id=task_id,
         status="pending",
         created_at=time.time()
-    )
+    ))
     
     # 添加后台任务
     background_tasks.add_task(
-        _process_task,
+        _run_task,
         task_id,
+        callback_url,
         upload_path,
         resolution,
         task_type,
         reference_text,
-        include_visualization
+        include_visualization,
+        cost
     )
     
     return OCRResponse(
@@ -98,86 +134,341 @@ async def upload_and_process(
     )
 
 
+async def _run_task(task_id: str, callback_url: Optional[str], *args):
+    """在独立的 asyncio 任务中执行 _process_task 并登记，使其可以被单独取消；结束后投递回调"""
+    work = asyncio.create_task(_process_task(task_id, *args))
+    _running_tasks[task_id] = work
+    try:
+        await work
+    finally:
+        _running_tasks.pop(task_id, None)
+
+    if callback_url:
+        task = await task_registry.get(task_id)
+        if task is not None and task.status in FINISHED_STATUSES:
+            schedule_webhook(callback_url, task.model_dump())
+
+
 async def _process_task(
     task_id: str,
     image_path: Path,
     resolution: str,
     task_type: str,
     reference_text: Optional[str],
-    include_visualization: bool
+    include_visualization: bool,
+    cost: float = 1.0
 ):
     """处理任务的内部函数
     
     此函数由 FastAPI 的 BackgroundTasks 在响应返回后自动调用。
     
     并发控制说明：
-    - 使用 asyncio.Semaphore 限制同时执行的任务数
+    - 由全局调度器 ocr_scheduler 分配引擎槽位（总数 OCR_SCHEDULER_CAPACITY，与同步接口共享）
     - 如果1000个请求同时到达：
       * 所有请求会立即返回任务ID（不阻塞）
-      * 但只有 MAX_CONCURRENT_OCR_TASKS 个任务会同时执行
-      * 其他任务会排队等待，直到有任务完成释放信号量
+      * 任务在调度器中排队（状态保持 pending），按优先级与客户端加权公平性依次执行，
+        同步接口的请求优先，单个客户端的大量任务不会饿死其他客户端
+      * 排队位置与预计等待时间可通过 /api/tasks/{task_id} 查询
     
     执行流程：
-    1. 获取信号量（如果已满则等待）
+    1. 获取调度槽位（如果已满则排队）
     2. 更新任务状态为 "processing"
     3. 调用服务层的 process_ocr_task 进行实际OCR处理
     4. 根据处理结果更新任务状态（completed 或 failed）
-    5. 释放信号量（允许下一个任务执行）
+    5. 释放槽位（调度下一个请求）
+
+    任务被 DELETE /api/tasks/{task_id} 取消时，排队条目被移除或引擎请求被中止，
+    状态更新为 cancelled。各阶段耗时记录在任务的 timings 中。
     """
-    # 使用信号量控制并发：如果已经有 MAX_CONCURRENT_OCR_TASKS 个任务在执行，
-    # 这里会等待，直到有任务完成并释放信号量
-    async with task_semaphore:
-        try:
-            logger.info(f"开始处理任务 {task_id} (当前并发: {MAX_CONCURRENT_OCR_TASKS - task_semaphore._value})")
-            tasks[task_id].status = "processing"
+    # 在 _run_task 创建的独立 asyncio 任务中执行，设置的上下文变量只对本任务生效
+    trace = Trace(task_id)
+    current_trace.set(trace)
+    try:
+        async with ocr_scheduler.slot(cost=cost):
+            # 取消请求可能由其他 worker 处理（SQLite 后端），开始执行前再确认一次
+            task = await task_registry.get(task_id)
+            if task is None or task.status == "cancelled":
+                logger.info(f"任务 {task_id} 已取消，跳过处理")
+                return
+            logger.info(f"开始处理任务 {task_id} (当前并发: {ocr_scheduler.active}/{ocr_scheduler.capacity})")
+            await task_registry.update(task_id, status="processing")
             result = await process_ocr_task(
                 task_id, image_path, resolution, task_type, reference_text, include_visualization
             )
-            tasks[task_id].status = "completed"
-            tasks[task_id].result = result
-            tasks[task_id].completed_at = time.time()
-            logger.info(f"任务 {task_id} 处理完成")
-        except Exception as e:
-            logger.exception(f"Error processing task {task_id}: {e}")
-            tasks[task_id].status = "failed"
-            tasks[task_id].error = str(e)
-            tasks[task_id].completed_at = time.time()
-            logger.error(f"任务 {task_id} 处理失败: {str(e)}")
-
-
-async def get_task_status(task_id: str):
-    """获取任务状态"""
-    if task_id not in tasks:
+        await task_registry.update(
+            task_id, status="completed", result=result, completed_at=time.time(), timings=trace.timings()
+        )
+        logger.info(f"任务 {task_id} 处理完成 | {trace.server_timing()}")
+    except asyncio.CancelledError:
+        await task_registry.update(
+            task_id, status="cancelled", completed_at=time.time(), timings=trace.timings()
+        )
+        logger.info(f"任务 {task_id} 已取消")
+    except Exception as e:
+        logger.exception(f"Error processing task {task_id}: {e}")
+        await task_registry.update(
+            task_id, status="failed", error=str(getattr(e, "detail", e)),
+            completed_at=time.time(), timings=trace.timings()
+        )
+        logger.error(f"任务 {task_id} 处理失败: {str(e)}")
+
+
+def _with_queue_position(task: TaskStatus) -> TaskStatus:
+    """排队中的任务附带排队位置与预计等待时间"""
+    if task.status == "pending":
+        queued = ocr_scheduler.position(task.task_id)
+        if queued is not None:
+            task.queue_position, task.estimated_wait = queued
+    return task
+
+
+async def get_task_status(task_id: str, wait: float = 0):
+    """获取任务状态
+
+    - wait: 长轮询等待时间（秒，不超过 OCR_TASK_MAX_WAIT）。任务未结束时，
+      等到状态发生变化或超时后再返回，避免客户端频繁轮询
+    """
+    task = await task_registry.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="任务不存在")
+
+    wait = min(max(wait, 0), TASK_MAX_WAIT)
+    if wait > 0 and task.status not in FINISHED_STATUSES:
+        task = await task_registry.wait_for_change(task_id, task.status, wait)
+        if task is None:
+            raise HTTPException(status_code=404, detail="任务不存在")
     
-    return tasks[task_id]
+    return _with_queue_position(task)
 
 
-async def list_tasks():
-    """列出所有任务"""
-    return list(tasks.values())
+async def task_events(task_id: str):
+    """以 SSE 推送任务状态变化
 
+    - status: 当前任务状态（结构同 /api/tasks/{task_id}），连接建立时推送一次，之后每次状态变化推送一次
+    - 任务结束（completed / failed / cancelled）后关闭连接
+    - 每 OCR_TASK_EVENTS_KEEPALIVE 秒发送一次注释行作为心跳，防止代理断开空闲连接
+    """
+    task = await task_registry.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return StreamingResponse(
+        _stream_task_events(task), media_type=SSE_MEDIA_TYPE, headers=STREAMING_HEADERS
+    )
 
-async def binary_ocr_endpoint(
-    image_data: UploadFile = File(...),
-    height: int = Form(...),
-    width: int = Form(...),
-    task_type: str = Form("markdown"),
-    resolution: str = Form("gundam")
+
+async def _stream_task_events(task: TaskStatus):
+    """逐个输出任务状态变化，任务结束后结束"""
+    yield format_sse(_with_queue_position(task).model_dump(), event="status")
+    while task.status not in FINISHED_STATUSES:
+        latest = await task_registry.wait_for_change(task.task_id, task.status, TASK_EVENTS_KEEPALIVE)
+        if latest is None:
+            yield format_sse({"detail": "任务不存在"}, event="error")
+            return
+        if latest.status == task.status:
+            yield ": keepalive\n\n"
+            continue
+        task = latest
+        yield format_sse(_with_queue_position(task).model_dump(), event="status")
+
+
+async def cancel_task(task_id: str):
+    """取消排队或执行中的任务
+
+    - 排队中：从调度器队列中移除
+    - 执行中：中止引擎请求并释放调度槽位（与其他请求合并的推理在没有其他等待者时才中止）
+    - 已结束的任务返回 409
+    """
+    task = await task_registry.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if task.status in FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"任务已结束: {task.status}")
+
+    work = _running_tasks.get(task_id)
+    if work is not None:
+        # 等待取消完成：槽位已释放、状态已更新
+        work.cancel()
+        await asyncio.wait({work})
+    else:
+        # 后台任务尚未开始或在其他 worker 中排队：标记后由其在获得槽位时跳过
+        await task_registry.update(task_id, status="cancelled", completed_at=time.time())
+        logger.info(f"任务 {task_id} 已标记为取消")
+
+    return await task_registry.get(task_id)
+
+
+async def list_tasks(
+    status: Optional[str] = None,
+    created_after: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50
 ):
-    """与 ocr_server 格式对齐的二进制 OCR 接口，但使用 DeepSeek 本地推理。"""
+    """按创建时间倒序分页列出任务（只含元数据，不含识别结果）
+
+    - status: 按任务状态过滤（pending / processing / completed / failed / cancelled）
+    - created_after: 只返回该时间戳之后创建的任务
+    - cursor: 上一页响应中的 next_cursor，为空时从最新的任务开始
+    - limit: 每页条数，不超过 OCR_TASK_LIST_MAX_LIMIT
+    """
+    limit = max(1, min(limit, TASK_LIST_MAX_LIMIT))
     try:
-        from app.services.ocr_service import run_deepseek_on_pil
-        import numpy as np
-        from PIL import Image
-        
-        # 读取并还原为 RGB 图
-        start_time = time.time()
-        image_bytes = await image_data.read()
-        img_array = np.frombuffer(image_bytes, dtype=np.uint8).reshape(height, width, 3)
-        pil_image = Image.fromarray(img_array, mode='RGB')
-
-        text, processed_text, results = await run_deepseek_on_pil(pil_image, task_type, resolution)
+        page, next_cursor = await task_registry.list(status, created_after, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return TaskListResponse(tasks=page, next_cursor=next_cursor)
+
+
+def _parse_bool(value, default: bool = False) -> bool:
+    """解析表单 / 查询参数中的布尔值"""
+    if value is None:
+        return default
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _binary_ocr_openapi() -> dict:
+    """/binary_ocr 的 OpenAPI 描述：接口手动解析请求体，参数需要显式声明才会出现在文档中"""
+    layout = {
+        "height": {"type": "integer", "description": "图片高度（像素）"},
+        "width": {"type": "integer", "description": "图片宽度（像素）"},
+        "pixel_format": {"type": "string", "enum": list(PIXEL_FORMATS), "default": "rgb"},
+        "row_stride": {"type": "integer", "description": "每行字节数（含行尾填充），默认紧密排列"},
+    }
+    options = {
+        "task_type": {"type": "string", "default": "markdown"},
+        "resolution": {"type": "string", "enum": list(RESOLUTION_CONFIGS), "default": "gundam"},
+        "stream": {"type": "boolean", "default": False, "description": "以 SSE 逐步推送增量文本"},
+    }
+    headers = [
+        ("X-Image-Width", "width"), ("X-Image-Height", "height"),
+        ("X-Pixel-Format", "pixel_format"), ("X-Row-Stride", "row_stride"),
+    ]
+    return {
+        "parameters": [
+            {
+                "name": header, "in": "header", "required": False, "schema": layout[field],
+                "description": f"application/octet-stream 请求的 {field}（multipart 请求使用表单字段）",
+            }
+            for header, field in headers
+        ] + [
+            {
+                "name": name, "in": "query", "required": False, "schema": schema,
+                "description": "application/octet-stream 请求使用（multipart 请求使用表单字段）",
+            }
+            for name, schema in options.items()
+        ],
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["image_data", "height", "width"],
+                        "properties": {
+                            "image_data": {"type": "string", "format": "binary", "description": "原始 uint8 像素"},
+                            **layout,
+                            **options,
+                        },
+                    },
+                },
+                "application/octet-stream": {
+                    "schema": {
+                        "type": "string", "format": "binary",
+                        "description": "原始 uint8 像素，尺寸与布局由 X-Image-* 请求头给出",
+                    },
+                },
+            },
+        },
+    }
+
+
+BINARY_OCR_OPENAPI = _binary_ocr_openapi()
+
+
+async def binary_ocr_endpoint(request: Request):
+    """与 ocr_server 格式对齐的二进制 OCR 接口，但使用 DeepSeek 本地推理。
+
+    支持两种请求体：
+    1. multipart/form-data（兼容 ocr_server）：
+       image_data（原始像素文件）、height、width、task_type、resolution、stream，
+       以及可选的 pixel_format、row_stride
+    2. application/octet-stream：请求体即原始像素，尺寸与布局由请求头给出：
+       X-Image-Width、X-Image-Height、X-Pixel-Format、X-Row-Stride；
+       task_type、resolution、stream 通过查询参数传递
+
+    pixel_format 可选 rgb（默认）/ bgr / rgba / rgbx / bgra / bgrx / gray，
+    row_stride 为每行字节数（含行尾填充），默认紧密排列。
+    像素缓冲区由 PIL raw 解码器直接读取，通道重排与行填充跳过在同一遍完成。
+    按像素缓冲区与像素布局查询结果缓存，命中时不解码。
+    stream=true 时以 SSE 逐步推送增量文本，最后推送 result 事件。
+    客户端断开连接时取消识别并中止引擎请求。
+    """
+    from app.services.ocr_service import run_deepseek_on_pil, stream_deepseek_on_pil, iter_cached_result
+
+    bind_job_context(request, Priority.INTERACTIVE)
+    start_time = time.time()
+    headers = request.headers
+    content_type = headers.get("content-type", "")
+
+    try:
+        image_data = None
+        if content_type.startswith("multipart/form-data"):
+            params = await request.form()
+            image_data = params.get("image_data")
+            if image_data is None or isinstance(image_data, str):
+                raise ValueError("缺少 image_data 文件")
+        else:
+            params = request.query_params
+
+        height = params.get("height") or headers.get("x-image-height")
+        width = params.get("width") or headers.get("x-image-width")
+        if height is None or width is None:
+            raise ValueError("缺少图片尺寸 height / width（或请求头 X-Image-Height / X-Image-Width）")
+        height, width = int(height), int(width)
+        pixel_format = params.get("pixel_format") or headers.get("x-pixel-format", "rgb")
+        row_stride = params.get("row_stride") or headers.get("x-row-stride")
+        row_stride = int(row_stride) if row_stride else None
+        task_type = params.get("task_type", "markdown")
+        resolution = params.get("resolution", "gundam")
+        stream = _parse_bool(params.get("stream"))
+
+        if image_data is not None:
+            # multipart 文件已由解析器分块落入临时文件，直接映射读取
+            with mapped_upload(image_data, MAX_RAW_IMAGE_SIZE) as pixel_buffer:
+                result_key, cached, pil_image = await _lookup_or_decode_raw(
+                    pixel_buffer, width, height, pixel_format, row_stride, task_type, resolution
+                )
+        else:
+            pixel_buffer = await read_request_body(request, MAX_RAW_IMAGE_SIZE)
+            result_key, cached, pil_image = await _lookup_or_decode_raw(
+                pixel_buffer, width, height, pixel_format, row_stride, task_type, resolution
+            )
+            del pixel_buffer
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"binary_ocr 参数错误: {str(e)}")
+
+    if cached is None:
+        # 准入控制：预计排队时间过长时返回 429
+        ocr_scheduler.admit(estimate_vision_tokens(width, height, resolution))
+
+    try:
+        if stream:
+            events = (
+                iter_cached_result(cached) if cached is not None
+                else stream_deepseek_on_pil(pil_image, task_type, resolution, result_key)
+            )
+            return StreamingResponse(
+                ocr_sse_events(events, {"width": width, "height": height}, start_time),
+                media_type=SSE_MEDIA_TYPE,
+                headers=STREAMING_HEADERS
+            )
+
+        if cached is not None:
+            text, processed_text, results = cached
+        else:
+            # 客户端断开连接时取消识别并中止引擎请求
+            text, processed_text, results = await run_until_disconnected(
+                request, run_deepseek_on_pil(pil_image, task_type, resolution, result_key)
+            )
         elapsed = time.time() - start_time
 
         return {
@@ -188,7 +479,130 @@ async def binary_ocr_endpoint(
             "text": text,
             "processed_text": processed_text
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Binary OCR error: {e}")
         raise HTTPException(status_code=500, detail=f"binary_ocr error: {str(e)}")
 
+
+async def _lookup_or_decode_raw(
+    pixel_buffer, width: int, height: int, pixel_format: str, row_stride: Optional[int],
+    task_type: str, resolution: str
+):
+    """按原始像素缓冲区查询结果缓存，未命中时解码，返回 (结果键, 缓存结果, 图片)
+
+    命中时不解码，图片为 None；缓冲区的哈希在线程中计算（不复制缓冲区）。
+    """
+    from app.services.ocr_service import find_cached_result
+    from app.utils.image_utils import image_from_raw_pixels
+
+    layout = f"{width}x{height}:{pixel_format}:{row_stride}"
+    digest = await asyncio.to_thread(raw_pixels_digest, pixel_buffer, layout)
+    result_key, cached = await find_cached_result(digest, task_type, resolution)
+    if cached is not None:
+        return result_key, cached, None
+    with span("image_decode"):
+        return result_key, None, image_from_raw_pixels(pixel_buffer, width, height, pixel_format, row_stride)
+
+
+async def batch_ocr_endpoint(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    task_type: str = Form("markdown"),
+    resolution: str = Form("gundam"),
+    concurrency: Optional[int] = Form(None),
+    stream: bool = Form(False)
+):
+    """批量图片 OCR 接口：一次请求上传多张图片（或 ZIP 压缩包），并发提交给共享引擎。
+
+    - 默认等待全部完成后按上传顺序返回 OCRBatchResponse
+    - stream=true 时以 NDJSON 输出，每完成一张即写出一行 OCRBatchItemResult（按完成顺序）
+    - 单张图片失败不影响其他图片，对应结果 success=false 并带 error
+    - 按 batch 优先级调度，不影响同步接口的延迟
+    """
+    bind_job_context(request, Priority.BATCH)
+    if resolution not in RESOLUTION_CONFIGS:
+        raise HTTPException(status_code=400, detail=f"不支持的分辨率: {resolution}")
+    if task_type not in TASK_PROMPTS and not task_type.startswith("<"):
+        raise HTTPException(status_code=400, detail=f"不支持的任务类型: {task_type}")
+    for upload in files:
+        check_upload_size(upload, _batch_upload_limit(upload))
+
+    # 上传文件在请求处理函数返回后即被关闭，先分块落盘，流式输出期间从磁盘读取
+    spooled = []
+    try:
+        for upload in files:
+            path = await spool_upload(
+                upload, _batch_upload_limit(upload), suffix=Path(upload.filename or "").suffix
+            )
+            spooled.append((upload.filename, upload.content_type, path))
+        items = await asyncio.to_thread(collect_batch_items, spooled)
+        if not items:
+            raise HTTPException(status_code=400, detail="未找到可识别的图片")
+        # 准入控制：按排在首张图片前面的工作估算排队时间，过长时返回 429；通过后尚未提交的图片
+        # （图片数 × 单张成本，尚未解码，按默认尺寸估算）登记为调度器的积压，计入之后请求的准入估算
+        backlog = ocr_scheduler.admit_backlog(len(items), estimate_vision_tokens(*DEFAULT_IMAGE_SIZE, resolution))
+    except ValueError as e:
+        _remove_files(spooled)
+        raise HTTPException(status_code=400, detail=str(e))
+    except zipfile.BadZipFile as e:
+        _remove_files(spooled)
+        raise HTTPException(status_code=400, detail=f"无效的 ZIP 文件: {str(e)}")
+    except BaseException:
+        _remove_files(spooled)
+        raise
+
+    start_time = time.time()
+    if stream:
+        return StreamingResponse(
+            _stream_batch_results(items, spooled, task_type, resolution, concurrency, backlog),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=STREAMING_HEADERS
+        )
+
+    async def collect_results():
+        async with aclosing(
+            iter_batch_results(items, task_type, resolution, concurrency, backlog)
+        ) as item_results:
+            return [item_result async for item_result in item_results]
+
+    try:
+        results = await run_until_disconnected(request, collect_results())
+    finally:
+        backlog.close()
+        _remove_files(spooled)
+    results.sort(key=lambda item_result: item_result["index"])
+
+    return OCRBatchResponse(
+        success=all(item_result["success"] for item_result in results),
+        results=results,
+        processing_time=round(time.time() - start_time, 4)
+    )
+
+
+def _batch_upload_limit(upload: UploadFile) -> int:
+    """批量接口中单个上传文件的大小限制（ZIP 按文档限制）"""
+    return MAX_DOCUMENT_SIZE if is_zip_upload(upload.filename, upload.content_type) else MAX_FILE_SIZE
+
+
+def _remove_files(spooled):
+    """删除批量请求落盘的临时文件"""
+    for _, _, path in spooled:
+        path.unlink(missing_ok=True)
+
+
+async def _stream_batch_results(
+    items, spooled, task_type: str, resolution: str, concurrency: Optional[int], backlog: Optional[Backlog] = None
+):
+    """逐张输出 NDJSON，结束后删除落盘的临时文件"""
+    try:
+        async with aclosing(
+            iter_batch_results(items, task_type, resolution, concurrency, backlog)
+        ) as item_results:
+            async for item_result in item_results:
+                yield format_ndjson(OCRBatchItemResult(**item_result).model_dump())
+    finally:
+        if backlog is not None:
+            backlog.close()
+        _remove_files(spooled)
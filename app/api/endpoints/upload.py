@@ -2,19 +2,36 @@
 文件上传相关端点
 """
 import time
+import asyncio
 import logging
-from io import BytesIO
-from fastapi import UploadFile, File, Form, HTTPException
+from pathlib import Path
+from typing import Optional
+from contextlib import aclosing
+from fastapi import UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import StreamingResponse
 
-from app.models.schemas import OCRUploadResponse, OCRPDFResponse
-from app.services.ocr_service import run_deepseek_on_pil
-from app.core.config import RESOLUTION_CONFIGS, TASK_PROMPTS
-from PIL import Image
+from app.models.schemas import OCRUploadResponse, OCRPDFResponse, OCRPDFPageResult
+from app.services.ocr_service import (
+    run_deepseek_on_pil, stream_deepseek_on_pil, estimate_vision_tokens, find_cached_result, iter_cached_result
+)
+from app.services.cache_service import file_digest
+from app.services.pdf_service import iter_pdf_page_results, estimate_page_tokens
+from app.services.scheduler import Priority, Backlog, bind_job_context, ocr_scheduler
+from app.services.preprocess_pool import decode_image
+from app.core.config import RESOLUTION_CONFIGS, TASK_PROMPTS, MAX_FILE_SIZE, MAX_DOCUMENT_SIZE
+from app.utils.upload_utils import check_upload_size, spool_upload
+from app.utils.image_utils import read_image_size
+from app.utils.disconnect import run_until_disconnected
+from app.core.tracing import span
+from app.utils.streaming import (
+    ocr_sse_events, format_ndjson, SSE_MEDIA_TYPE, NDJSON_MEDIA_TYPE, STREAMING_HEADERS
+)
 
 logger = logging.getLogger(__name__)
 
 
 async def upload_image_endpoint(
+    request: Request,
     file: UploadFile = File(...),
     use_det: bool = Form(True),
     use_cls: bool = Form(True),
@@ -24,41 +41,87 @@ async def upload_image_endpoint(
     unclip_ratio: float = Form(1.6),
     return_word_box: bool = Form(False),
     task_type: str = Form("markdown"),
-    resolution: str = Form("gundam")
+    resolution: str = Form("gundam"),
+    stream: bool = Form(False)
 ):
     """与 ocr_server 的 /upload 同名的图片上传接口，但使用 DeepSeek 本地推理。
     兼容接收 ocr_server 的表单参数（目前本地推理未用 det/cls/rec 等开关）。
+    stream=true 时以 SSE 逐步推送增量文本，最后推送 result 事件（结构同同步响应）。
+    按 interactive 优先级调度，客户端断开连接时取消识别。
+    按上传文件的编码字节查询结果缓存，命中时不解码图片（只读取图片头获取尺寸）。
     """
+    bind_job_context(request, Priority.INTERACTIVE)
     try:
-        # 检查文件类型（尽量兼容常见图片）
-        content = await file.read()
+        check_upload_size(file, MAX_FILE_SIZE)
         start_time = time.time()
-        image = Image.open(BytesIO(content)).convert('RGB')
+        digest = await asyncio.to_thread(file_digest, file.file)
+        result_key, cached = await find_cached_result(digest, task_type, resolution)
+        try:
+            if cached is not None:
+                width, height = await asyncio.to_thread(read_image_size, file.file)
+            else:
+                # 从解析器的临时文件解码（尽量兼容常见图片），在预处理进程池中执行
+                with span("image_decode"):
+                    image = await decode_image(file.file)
+                width, height = image.size
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"无法识别的图片: {str(e)}")
+        image_size = {"width": width, "height": height}
+        if cached is None:
+            # 准入控制：预计排队时间过长时返回 429
+            ocr_scheduler.admit(estimate_vision_tokens(width, height, resolution))
+
+        if stream:
+            events = (
+                iter_cached_result(cached) if cached is not None
+                else stream_deepseek_on_pil(image, task_type, resolution, result_key)
+            )
+            return StreamingResponse(
+                ocr_sse_events(events, image_size, start_time),
+                media_type=SSE_MEDIA_TYPE,
+                headers=STREAMING_HEADERS
+            )
 
-        text, processed_text, results = await run_deepseek_on_pil(image, task_type, resolution)
+        if cached is not None:
+            text, processed_text, results = cached
+        else:
+            # 客户端断开连接时取消识别并中止引擎请求
+            text, processed_text, results = await run_until_disconnected(
+                request, run_deepseek_on_pil(image, task_type, resolution, result_key)
+            )
         elapsed = time.time() - start_time
 
         return OCRUploadResponse(
             success=True,
             results=results,
             processing_time=round(elapsed, 4),
-            image_size={"width": image.size[0], "height": image.size[1]},
+            image_size=image_size,
             text=text,
             processed_text=processed_text
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=f"upload error: {str(e)}")
 
 
 async def upload_pdf_endpoint(
+    request: Request,
     file: UploadFile = File(...),
     task_type: str = Form("markdown"),
-    resolution: str = Form("gundam")
+    resolution: str = Form("gundam"),
+    page_concurrency: Optional[int] = Form(None),
+    stream: bool = Form(False)
 ):
     """与 ocr_server 名称保持一致的 PDF OCR 接口，使用 DeepSeek 本地推理。
     通过 PyMuPDF 渲染每一页为图像后进行识别。
+    各页以流水线方式并发提交给引擎（page_concurrency 不超过 PDF_PAGE_CONCURRENCY），
+    结果按页码顺序返回。
+    stream=true 时以 NDJSON 输出，每完成一页即写出一行 OCRPDFPageResult（按完成顺序）。
+    各页按 batch 优先级调度，客户端断开连接时取消尚未完成的页。
     """
+    bind_job_context(request, Priority.BATCH)
     try:
         try:
             import fitz  # PyMuPDF
@@ -68,33 +131,47 @@ async def upload_pdf_endpoint(
                 detail="需要安装 PyMuPDF (fitz) 才能处理 PDF，请在镜像中加入 pymupdf 依赖。"
             )
 
-        pdf_bytes = await file.read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        results_pages = []
-
-        for page_index in range(len(doc)):
-            page = doc[page_index]
-            # 将整页渲染为位图（避免依赖提取内嵌图片能力）
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x 放大，清晰些
-            img_data = pix.tobytes("png")
-            pil_image = Image.open(BytesIO(img_data)).convert('RGB')
-
-            page_start = time.time()
-            text, processed_text, results = await run_deepseek_on_pil(pil_image, task_type, resolution)
-            page_elapsed = time.time() - page_start
-
-            results_pages.append({
-                "page": page_index + 1,
-                "index": 0,
-                "result": results,
-                "bbox_image": [0, 0, pil_image.size[0], pil_image.size[1]],
-                "processing_time": round(page_elapsed, 4),
-                "image_size": {"width": pil_image.size[0], "height": pil_image.size[1]},
-                "text": text,
-                "processed_text": processed_text
-            })
+        # 分块落盘后由 PyMuPDF 按需从文件读取，不在内存中保留整个 PDF
+        pdf_path = await spool_upload(file, MAX_DOCUMENT_SIZE, suffix=".pdf")
+        try:
+            doc = fitz.open(str(pdf_path), filetype="pdf")
+        except Exception:
+            pdf_path.unlink(missing_ok=True)
+            raise
 
-        doc.close()
+        # 准入控制：按排在首页前面的工作估算排队时间，过长时返回 429；
+        # 通过后尚未提交的页面（页数 × 单页成本）登记为调度器的积压，计入之后请求的准入估算
+        backlog = None
+        try:
+            if len(doc):
+                backlog = ocr_scheduler.admit_backlog(len(doc), estimate_page_tokens(doc, resolution))
+        except HTTPException:
+            doc.close()
+            pdf_path.unlink(missing_ok=True)
+            raise
+
+        if stream:
+            return StreamingResponse(
+                _stream_pdf_pages(doc, pdf_path, task_type, resolution, page_concurrency, backlog),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers=STREAMING_HEADERS
+            )
+
+        async def collect_pages():
+            async with aclosing(
+                iter_pdf_page_results(doc, task_type, resolution, page_concurrency, backlog)
+            ) as page_results:
+                return [page_result async for page_result in page_results]
+
+        try:
+            results_pages = await run_until_disconnected(request, collect_pages())
+        finally:
+            if backlog is not None:
+                backlog.close()
+            doc.close()
+            pdf_path.unlink(missing_ok=True)
+
+        results_pages.sort(key=lambda page_result: page_result["page"])
         return OCRPDFResponse(success=True, results=results_pages)
     except HTTPException:
         raise
@@ -102,3 +179,24 @@ async def upload_pdf_endpoint(
         logger.exception(f"Upload PDF error: {e}")
         raise HTTPException(status_code=500, detail=f"upload_pdf error: {str(e)}")
 
+
+async def _stream_pdf_pages(
+    doc, pdf_path: Path, task_type: str, resolution: str, page_concurrency: Optional[int],
+    backlog: Optional[Backlog] = None
+):
+    """逐页输出 NDJSON，写出后即释放该页的图像与文本；出错时输出一行错误信息"""
+    try:
+        async with aclosing(
+            iter_pdf_page_results(doc, task_type, resolution, page_concurrency, backlog)
+        ) as page_results:
+            async for page_result in page_results:
+                yield format_ndjson(OCRPDFPageResult(**page_result).model_dump())
+                del page_result
+    except Exception as e:
+        logger.exception(f"Upload PDF stream error: {e}")
+        yield format_ndjson({"success": False, "error": f"upload_pdf error: {str(e)}"})
+    finally:
+        if backlog is not None:
+            backlog.close()
+        doc.close()
+        pdf_path.unlink(missing_ok=True)
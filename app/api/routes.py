@@ -14,9 +14,14 @@ api_router.add_api_route("/", health.root, methods=["GET"], tags=["health"])
 
 # 注册OCR路由
 api_router.add_api_route("/api/ocr", ocr.upload_and_process, methods=["POST"], tags=["ocr"])
+api_router.add_api_route("/api/ocr/batch", ocr.batch_ocr_endpoint, methods=["POST"], tags=["ocr"])
 api_router.add_api_route("/api/tasks/{task_id}", ocr.get_task_status, methods=["GET"], tags=["ocr"])
+api_router.add_api_route("/api/tasks/{task_id}", ocr.cancel_task, methods=["DELETE"], tags=["ocr"])
+api_router.add_api_route("/api/tasks/{task_id}/events", ocr.task_events, methods=["GET"], tags=["ocr"])
 api_router.add_api_route("/api/tasks", ocr.list_tasks, methods=["GET"], tags=["ocr"])
-api_router.add_api_route("/binary_ocr", ocr.binary_ocr_endpoint, methods=["POST"], tags=["ocr"])
+api_router.add_api_route(
+    "/binary_ocr", ocr.binary_ocr_endpoint, methods=["POST"], tags=["ocr"], openapi_extra=ocr.BINARY_OCR_OPENAPI
+)
 api_router.add_api_route("/upload", upload.upload_image_endpoint, methods=["POST"], tags=["upload"])
 api_router.add_api_route("/upload_pdf", upload.upload_pdf_endpoint, methods=["POST"], tags=["upload"])
 
@@ -34,12 +34,63 @@ RELOAD = os.getenv("OCR_RELOAD", "false").lower() == "true"
 # 文件上传配置
 UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "/app/uploads"))
 OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "/app/outputs"))
-MAX_FILE_SIZE = int(os.getenv("OCR_MAX_FILE_SIZE", "10485760"))  # 10MB
+MAX_FILE_SIZE = int(os.getenv("OCR_MAX_FILE_SIZE", "10485760"))  # 10MB，单张编码图片
+MAX_RAW_IMAGE_SIZE = int(os.getenv("OCR_MAX_RAW_IMAGE_SIZE", "67108864"))  # 64MB，binary_ocr 原始像素
+MAX_DOCUMENT_SIZE = int(os.getenv("OCR_MAX_DOCUMENT_SIZE", "104857600"))  # 100MB，PDF / ZIP
+MAX_REQUEST_SIZE = int(os.getenv("OCR_MAX_REQUEST_SIZE", "268435456"))  # 256MB，整个请求体
+UPLOAD_FORM_OVERHEAD = int(os.getenv("OCR_UPLOAD_FORM_OVERHEAD", "65536"))  # 64KB，单文件上传路由中表单字段与 multipart 边界的余量
+UPLOAD_CHUNK_SIZE = int(os.getenv("OCR_UPLOAD_CHUNK_SIZE", "1048576"))  # 1MB，分块读取大小
+MAX_IMAGE_PIXELS = int(os.getenv("OCR_MAX_IMAGE_PIXELS", "50000000"))  # 编码图片解码后的最大像素数，超过时不解码
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
 
+# PDF 处理配置
+PDF_RENDER_ZOOM = float(os.getenv("PDF_RENDER_ZOOM", "2"))  # 渲染放大倍数
+PDF_PAGE_CONCURRENCY = int(os.getenv("PDF_PAGE_CONCURRENCY", "8"))  # 单个文档同时识别的最大页数
+
+# 批量 OCR 配置
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "256"))  # 单次批量请求最多图片数
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))  # 单次批量请求同时识别的最大图片数
+
+# 结果缓存配置（按图片内容 + 任务类型 + 分辨率 + 提示词 + 模型寻址）
+CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", "268435456"))  # 256MB，内存层上限
+CACHE_DIR = os.getenv("OCR_CACHE_DIR", "")  # 磁盘层目录，留空则不启用磁盘层
+CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", "604800"))  # 7 天，磁盘层条目有效期（秒）
+
+# 调度配置
+# 同时提交给引擎的最大请求数，超出部分在调度器中按优先级与客户端公平性排队
+# 同步接口（/upload、/upload_pdf、批量）与 /api/ocr 任务共享这些槽位；
+# 默认值与旧的 MAX_CONCURRENT_OCR_TASKS 相同（min(MAX_CONCURRENCY, 3)），并兼容该环境变量
+SCHEDULER_CAPACITY = int(
+    os.getenv("OCR_SCHEDULER_CAPACITY", os.getenv("MAX_CONCURRENT_OCR_TASKS", str(min(MAX_CONCURRENCY, 3))))
+)
+DEADLINE_POLICY = os.getenv("OCR_DEADLINE_POLICY", "drop")  # 排队超过截止时间：drop（返回 504）/ demote（降为 batch）
+CLIENT_WEIGHTS = os.getenv("OCR_CLIENT_WEIGHTS", "")  # 客户端权重，如 "team-a=4,bulk-importer=0.5"，默认 1
+MAX_QUEUE_SECONDS = float(os.getenv("OCR_MAX_QUEUE_SECONDS", "300"))  # 预计排队时间上限，超过返回 429，0 表示不限制
+
+# 任务注册表配置
+TASK_BACKEND = os.getenv("OCR_TASK_BACKEND", "memory")  # memory / sqlite（重启后保留任务）
+DATA_DIR = Path(os.getenv("OCR_DATA_DIR", "/app/data"))  # SQLite 数据库与落盘的任务结果
+TASK_TTL = int(os.getenv("OCR_TASK_TTL", "86400"))  # 1 天，已结束任务的保留时间（秒）
+TASK_MAX_TASKS = int(os.getenv("OCR_TASK_MAX_TASKS", "10000"))  # 最多保留的任务数
+TASK_RESULT_INLINE_BYTES = int(os.getenv("OCR_TASK_RESULT_INLINE_BYTES", "65536"))  # 超过则结果落盘
+TASK_LIST_MAX_LIMIT = int(os.getenv("OCR_TASK_LIST_MAX_LIMIT", "200"))  # /api/tasks 单页最多条数
+TASK_MAX_WAIT = float(os.getenv("OCR_TASK_MAX_WAIT", "60"))  # 长轮询 ?wait= 的最长等待时间（秒）
+TASK_WATCH_INTERVAL = float(os.getenv("OCR_TASK_WATCH_INTERVAL", "1.0"))  # sqlite 后端检查其他 worker 更新的间隔（秒）
+TASK_EVENTS_KEEPALIVE = float(os.getenv("OCR_TASK_EVENTS_KEEPALIVE", "15"))  # 任务状态 SSE 的心跳间隔（秒）
+
+# 任务完成回调（webhook）配置
+WEBHOOK_MAX_RETRIES = int(os.getenv("OCR_WEBHOOK_MAX_RETRIES", "5"))  # 投递失败后的最大重试次数
+WEBHOOK_BACKOFF = float(os.getenv("OCR_WEBHOOK_BACKOFF", "1.0"))  # 首次重试的等待时间（秒），之后按指数增长
+WEBHOOK_TIMEOUT = float(os.getenv("OCR_WEBHOOK_TIMEOUT", "10"))  # 单次投递的超时时间（秒）
+WEBHOOK_SECRET = os.getenv("OCR_WEBHOOK_SECRET", "")  # 设置后以 HMAC-SHA256 签名请求体（X-OCR-Signature 头）
+# 允许回调的内网地址：逗号分隔的主机名、IP 或网段（如 "hooks.internal,10.0.0.0/8"），默认只允许公网地址
+WEBHOOK_ALLOWED_HOSTS = os.getenv("OCR_WEBHOOK_ALLOWED_HOSTS", "")
+
 # 创建必要的目录
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 # 分辨率配置映射
 RESOLUTION_CONFIGS = {
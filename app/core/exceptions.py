@@ -24,6 +24,7 @@ async def not_found_handler(request: Request, exc):
                 "/",
                 "/health",
                 "/api/ocr",
+                "/api/ocr/batch",
                 "/api/tasks",
                 "/upload",
                 "/upload_pdf",
@@ -16,6 +16,7 @@ sys.path.append('/app/DeepSeek-OCR-vllm')
 
 from deepseek_ocr import DeepseekOCRForCausalLM
 from process.image_process import DeepseekOCRProcessor
+from app.services.preprocess_pool import start_preprocess_pool, shutdown_preprocess_pool
 from app.core.config import (
     MODEL_PATH, BASE_SIZE, IMAGE_SIZE, CROP_MODE, PROMPT
 )
@@ -58,6 +59,9 @@ async def lifespan(app: FastAPI):
         # 初始化处理器
         processor = DeepseekOCRProcessor()
         logger.info("Processor initialized")
+
+        # 启动 CPU 预处理进程池（NUM_WORKERS 个进程）
+        start_preprocess_pool()
         
         # 初始化引擎
         engine_args = AsyncEngineArgs(
@@ -81,6 +85,8 @@ async def lifespan(app: FastAPI):
     yield
     
     # 清理资源
+    shutdown_preprocess_pool()
+
     if engine is not None:
         del engine
         engine = None
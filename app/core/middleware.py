@@ -3,18 +3,31 @@
 """
 import time
 import logging
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from app.core.tracing import Trace, current_trace, request_id_from_header
 
 logger = logging.getLogger(__name__)
 
 
 async def log_requests_middleware(request, call_next):
-    """记录所有请求的中间件"""
+    """记录所有请求的中间件
+
+    为每个请求建立 Trace（请求 ID 取自 X-Request-ID 请求头或由服务端生成），
+    响应头返回 X-Request-ID 与各阶段耗时 Server-Timing。
+    流式响应的响应头在开始输出时发送，只包含此前的阶段。
+    """
     start_time = time.time()
+    trace = Trace(request_id_from_header(request.headers.get("x-request-id")))
+    current_trace.set(trace)
 
     # 记录请求信息
     logger.info(
         f"收到OCR请求 | {request.method} {request.url.path} | "
-        f"IP: {request.client.host if request.client else 'unknown'}"
+        f"IP: {request.client.host if request.client else 'unknown'} | 请求ID: {trace.request_id}"
     )
 
     # 记录请求头
@@ -31,13 +44,74 @@ async def log_requests_middleware(request, call_next):
     process_time = time.time() - start_time
 
     # 记录响应信息
+    server_timing = trace.server_timing()
     logger.info(
         f"OCR响应完成 | {request.method} {request.url.path} | "
-        f"状态码: {response.status_code} | 耗时: {process_time:.3f}s"
+        f"状态码: {response.status_code} | 耗时: {process_time:.3f}s | {server_timing}"
     )
 
-    # 添加处理时间到响应头
+    # 添加处理时间、请求 ID 与分阶段耗时到响应头
     response.headers["X-Process-Time"] = str(process_time)
+    response.headers["X-Request-ID"] = trace.request_id
+    response.headers["Server-Timing"] = server_timing
 
     return response
 
+
+
+class RequestSizeLimitMiddleware:
+    """限制请求体大小的 ASGI 中间件
+
+    - 带 Content-Length 且超限的请求在读取请求体之前直接返回 413
+    - 分块传输（无 Content-Length）的请求在累计接收超限时中断读取并返回 413
+    - route_limits 按路由路径（不含 root_path）给出更小的上限，如单文件上传路由按文件大小限制加表单开销，
+      使超限的上传在 multipart 解析器把文件落盘之前即被拒绝；未列出的路由使用 max_size
+    """
+
+    def __init__(self, app, max_size: int, route_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_size = max_size
+        self.route_limits = route_limits or {}
+
+    def _limit_for(self, scope) -> int:
+        path = scope.get("path", "")
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        return min(self.route_limits.get(path, self.max_size), self.max_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        max_size = self._limit_for(scope)
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_size:
+            logger.warning(
+                f"请求体过大 | {scope.get('method')} {scope.get('path')} | "
+                f"Content-Length: {int(content_length)} > {max_size}"
+            )
+            response = JSONResponse(
+                status_code=413,
+                content={"detail": f"请求体超过大小限制 {max_size} 字节"}
+            )
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_size:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"请求体超过大小限制 {max_size} 字节"
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
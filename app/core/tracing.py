@@ -0,0 +1,83 @@
+"""
+请求追踪：请求 ID 与分阶段耗时
+
+每个 HTTP 请求（以及每个 /api/ocr 后台任务）对应一个 Trace，通过 contextvar 在调用链中传递。
+各阶段调用 span() 记录耗时，同名阶段累加（批量 / PDF 请求中为所有图片的合计）：
+
+- queue: 在调度器中排队等待槽位
+- image_decode: 图片解码 / PDF 页面渲染
+- tokenize: tokenize_with_images 预处理
+- ttft: 提交给引擎到产出第一个 token
+- generate: 第一个 token 之后的解码
+- parse: re_match 等输出解析
+- visualize: 绘制检测框并保存可视化结果
+
+耗时通过 Server-Timing 响应头与 TaskStatus.timings 暴露，用于区分慢请求是 CPU 还是 GPU 瓶颈。
+"""
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+# 客户端传入的 X-Request-ID 只保留安全字符，避免注入响应头 / 日志
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+
+class Trace:
+    """一个请求的 ID 与各阶段累计耗时"""
+
+    def __init__(self, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self._spans: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        """累加一个阶段的耗时（秒）"""
+        self._spans[name] = self._spans.get(name, 0.0) + seconds
+
+    def timings(self) -> Dict[str, float]:
+        """各阶段耗时（毫秒），按首次记录的顺序"""
+        return {name: round(seconds * 1000, 3) for name, seconds in self._spans.items()}
+
+    def server_timing(self) -> str:
+        """编码为 Server-Timing 响应头，附带请求总耗时 total"""
+        entries = [f"{name};dur={ms:.1f}" for name, ms in self.timings().items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def request_id_from_header(value: Optional[str]) -> Optional[str]:
+    """校验客户端传入的 X-Request-ID，不合法时返回 None（由服务端生成）"""
+    if value and _REQUEST_ID_PATTERN.match(value):
+        return value
+    return None
+
+
+def engine_request_id() -> str:
+    """生成提交给引擎的请求 ID：以当前请求 ID 为前缀便于关联日志，随机后缀保证唯一"""
+    trace = current_trace.get()
+    prefix = trace.request_id if trace is not None else "request"
+    return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+
+def record_span(name: str, seconds: float):
+    """向当前请求记录一个阶段的耗时，没有当前请求时忽略"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(name, seconds)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """记录代码块的耗时（可包裹 await）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
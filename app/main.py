@@ -9,13 +9,15 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app.core.logging_config import setup_logging
 from app.core.lifespan import lifespan
-from app.core.middleware import log_requests_middleware
+from app.core.middleware import log_requests_middleware, RequestSizeLimitMiddleware
 from app.core.exceptions import (
     not_found_handler,
     global_exception_handler,
     validation_exception_handler
 )
-from app.core.config import OUTPUT_DIR
+from app.core.config import (
+    OUTPUT_DIR, MAX_REQUEST_SIZE, MAX_FILE_SIZE, MAX_RAW_IMAGE_SIZE, MAX_DOCUMENT_SIZE, UPLOAD_FORM_OVERHEAD
+)
 from app.api.routes import api_router
 
 # 配置日志
@@ -40,7 +42,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 注册中间件
+# 单文件上传路由的请求体上限（文件大小限制加表单余量），在接收请求体时即拒绝超限的上传；
+# 批量接口包含多个文件，只受 MAX_REQUEST_SIZE 限制，单个文件的大小在解析后检查
+UPLOAD_ROUTE_LIMITS = {
+    "/upload": MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD,
+    "/api/ocr": MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD,
+    "/upload_pdf": MAX_DOCUMENT_SIZE + UPLOAD_FORM_OVERHEAD,
+    "/binary_ocr": MAX_RAW_IMAGE_SIZE + UPLOAD_FORM_OVERHEAD,
+}
+
+# 注册中间件（后注册的在外层：请求先经过日志中间件，再经过请求体大小限制）
+app.add_middleware(RequestSizeLimitMiddleware, max_size=MAX_REQUEST_SIZE, route_limits=UPLOAD_ROUTE_LIMITS)
 app.middleware("http")(log_requests_middleware)
 
 # 注册异常处理器
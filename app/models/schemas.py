@@ -26,11 +26,20 @@ class OCRResponse(BaseModel):
 class TaskStatus(BaseModel):
     """任务状态模型"""
     task_id: str
-    status: str  # pending, processing, completed, failed
+    status: str  # pending, processing, completed, failed, cancelled
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
     created_at: float
     completed_at: Optional[float] = None
+    queue_position: Optional[int] = None  # 排队中时前面的请求数
+    estimated_wait: Optional[float] = None  # 排队中时的预计等待时间（秒）
+    timings: Optional[Dict[str, float]] = None  # 结束后各阶段耗时（毫秒），见 app/core/tracing.py
+
+
+class TaskListResponse(BaseModel):
+    """任务列表响应模型（只含任务元数据，结果通过 /api/tasks/{task_id} 获取）"""
+    tasks: List[TaskStatus]
+    next_cursor: Optional[str] = None
 
 
 class OCRResult(BaseModel):
@@ -68,3 +77,23 @@ class OCRPDFResponse(BaseModel):
     success: bool
     results: List[OCRPDFPageResult]
 
+
+
+class OCRBatchItemResult(BaseModel):
+    """批量 OCR 单张图片结果模型"""
+    index: int
+    filename: Optional[str] = None
+    success: bool
+    results: List[OCRResult] = []
+    processing_time: float
+    image_size: Optional[Dict[str, int]] = None
+    text: Optional[str] = None
+    processed_text: Optional[str] = None
+    error: Optional[str] = None
+
+
+class OCRBatchResponse(BaseModel):
+    """批量 OCR 响应模型"""
+    success: bool
+    results: List[OCRBatchItemResult]
+    processing_time: float
@@ -0,0 +1,140 @@
+"""
+批量图片 OCR 业务逻辑服务
+"""
+import io
+import time
+import asyncio
+import logging
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Any, List, Optional, Tuple, Union
+
+from app.services.ocr_service import run_deepseek_on_pil, find_cached_result
+from app.services.cache_service import file_digest
+from app.services.preprocess_pool import decode_image
+from app.services.scheduler import Backlog
+from app.core.tracing import span
+from app.utils.image_utils import read_image_size
+from app.core.config import ALLOWED_EXTENSIONS, BATCH_CONCURRENCY, BATCH_MAX_IMAGES, MAX_FILE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 批量条目：(文件名, 在线程中取得图片编码字节的函数：磁盘文件路径或内存中的文件对象)
+BatchItem = Tuple[str, Callable[[], Union[Path, BinaryIO]]]
+# 已落盘的上传文件：(原始文件名, Content-Type, 临时文件路径)
+SpooledUpload = Tuple[Optional[str], Optional[str], Path]
+
+
+def _read_zip_member(zip_path: Path, name: str) -> BinaryIO:
+    """读取压缩包中一张图片的编码字节（每次独立打开压缩包，可在多个线程中并发调用）
+
+    成员大小已在展开时按 MAX_FILE_SIZE 检查；读入内存后计算哈希与解码不必重复解压。
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        return io.BytesIO(archive.read(name))
+
+
+def is_zip_upload(filename: Optional[str], content_type: Optional[str]) -> bool:
+    """判断上传文件是否为 ZIP 压缩包"""
+    return (Path(filename or "").suffix.lower() == ".zip"
+            or content_type in ("application/zip", "application/x-zip-compressed"))
+
+
+def collect_batch_items(uploads: List[SpooledUpload]) -> List[BatchItem]:
+    """将已落盘的图片文件与 ZIP 压缩包展开为批量条目（此时不解码图片）
+
+    条目只引用磁盘上的临时文件，请求处理函数返回后（流式输出期间）仍可读取。
+    ZIP 中仅保留扩展名在 ALLOWED_EXTENSIONS 内的文件，目录与 macOS 元数据会被跳过。
+    """
+    items: List[BatchItem] = []
+    for filename, content_type, path in uploads:
+        if is_zip_upload(filename, content_type):
+            with zipfile.ZipFile(path) as archive:
+                members = archive.infolist()
+            for info in members:
+                name = info.filename
+                if info.is_dir() or name.startswith("__MACOSX/"):
+                    continue
+                if Path(name).suffix.lower() not in ALLOWED_EXTENSIONS:
+                    continue
+                if info.file_size > MAX_FILE_SIZE:
+                    raise ValueError(f"压缩包内文件 {name} 超过大小限制 {MAX_FILE_SIZE} 字节")
+                items.append((name, lambda path=path, name=name: _read_zip_member(path, name)))
+        else:
+            items.append((filename, lambda path=path: path))
+
+        if len(items) > BATCH_MAX_IMAGES:
+            raise ValueError(f"单次批量请求最多 {BATCH_MAX_IMAGES} 张图片")
+    return items
+
+
+async def iter_batch_results(
+    items: List[BatchItem],
+    task_type: str = "markdown",
+    resolution: str = "gundam",
+    concurrency: Optional[int] = None,
+    backlog: Optional[Backlog] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """并发识别批量图片，按完成顺序产出每张图片的结果
+
+    - 按编码字节查询结果缓存，命中时不解码；未命中时在预处理进程池中解码，不阻塞事件循环
+    - 最多同时有 concurrency 张图片处于解码/识别中，其余排队，
+      同时在引擎中的请求由 AsyncLLMEngine 连续批处理
+    - 单张图片失败不影响其他图片，失败结果带 error 字段
+    - backlog 为准入时登记的积压（ocr_scheduler.admit_backlog），每张开始处理时扣减，结束时关闭
+    """
+    concurrency = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, filename: str, open_source: Callable[[], Union[Path, BinaryIO]]):
+        async with slots:
+            item_start = time.time()
+            if backlog is not None:
+                backlog.take()
+            try:
+                source = await asyncio.to_thread(open_source)
+                digest = await asyncio.to_thread(file_digest, source)
+                result_key, cached = await find_cached_result(digest, task_type, resolution)
+                if cached is not None:
+                    width, height = await asyncio.to_thread(read_image_size, source)
+                    text, processed_text, results = cached
+                else:
+                    with span("image_decode"):
+                        image = await decode_image(source)
+                    width, height = image.size
+                    text, processed_text, results = await run_deepseek_on_pil(
+                        image, task_type, resolution, result_key
+                    )
+                return {
+                    "index": index,
+                    "filename": filename,
+                    "success": True,
+                    "results": results,
+                    "processing_time": round(time.time() - item_start, 4),
+                    "image_size": {"width": width, "height": height},
+                    "text": text,
+                    "processed_text": processed_text
+                }
+            except Exception as e:
+                logger.exception(f"Batch OCR error on {filename}: {e}")
+                return {
+                    "index": index,
+                    "filename": filename,
+                    "success": False,
+                    "processing_time": round(time.time() - item_start, 4),
+                    "error": str(e)
+                }
+
+    item_tasks = [
+        asyncio.create_task(run_item(index, filename, open_source))
+        for index, (filename, open_source) in enumerate(items)
+    ]
+    try:
+        for next_done in asyncio.as_completed(item_tasks):
+            yield await next_done
+    finally:
+        if backlog is not None:
+            backlog.close()
+        for task in item_tasks:
+            task.cancel()
+        await asyncio.gather(*item_tasks, return_exceptions=True)
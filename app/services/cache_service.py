@@ -0,0 +1,188 @@
+"""
+OCR 结果缓存服务
+
+缓存键由图片字节的哈希、任务类型、分辨率、提示词与模型路径共同决定，
+命中时直接返回保存的原始文本、处理后文本与矩形结果，跳过解码、预处理与 GPU 推理。
+
+- 上传的图片按编码字节（文件内容）计算哈希，binary_ocr 按原始像素缓冲区与像素布局计算，
+  在解码之前即可查询缓存
+- 没有编码字节的图片（如 PDF 渲染出的页面）按像素内容计算
+
+- 内存层：按字节数限制的 LRU，条目以 JSON 编码保存，调用方拿到的总是新对象
+- 磁盘层（可选）：OCR_CACHE_DIR 下每个条目一个 JSON 文件，超过 OCR_CACHE_TTL 即失效
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+from PIL import Image
+
+from app.core.config import (
+    MODEL_PATH, CACHE_ENABLED, CACHE_MAX_BYTES, CACHE_DIR, CACHE_TTL, UPLOAD_CHUNK_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# 缓存条目格式版本，格式或后处理逻辑变化时递增，使旧条目失效
+CACHE_VERSION = "1"
+
+# 磁盘层过期条目清理的最小间隔（秒）
+DISK_SWEEP_INTERVAL = 3600
+
+
+def file_digest(source: Union[Path, BinaryIO]) -> str:
+    """按块计算图片文件编码字节的哈希（不解码图片）；文件对象读取后回到开头"""
+    hasher = hashlib.blake2b(b"file:", digest_size=32)
+    fileobj = open(source, "rb") if isinstance(source, Path) else source
+    try:
+        fileobj.seek(0)
+        while chunk := fileobj.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    finally:
+        if fileobj is source:
+            fileobj.seek(0)
+        else:
+            fileobj.close()
+    return hasher.hexdigest()
+
+
+def raw_pixels_digest(buffer, layout: str) -> str:
+    """计算原始像素缓冲区（bytes / memoryview / mmap，不复制）的哈希，layout 描述尺寸与像素格式"""
+    hasher = hashlib.blake2b(f"raw:{layout}:".encode(), digest_size=32)
+    hasher.update(buffer)
+    return hasher.hexdigest()
+
+
+def image_digest(image: Image.Image) -> str:
+    """计算图片像素内容的哈希，用于没有编码字节的图片（如 PDF 渲染出的页面）"""
+    hasher = hashlib.blake2b(digest_size=32)
+    hasher.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+def make_result_key(digest: str, task_type: str, resolution: str, prompt: str) -> str:
+    """由图片哈希（file_digest / raw_pixels_digest / image_digest）生成识别结果的内容寻址键"""
+    parts = [CACHE_VERSION, MODEL_PATH, task_type, resolution, prompt, digest]
+    return hashlib.blake2b("\0".join(parts).encode(), digest_size=32).hexdigest()
+
+
+class OCRResultCache:
+    """内容寻址的 OCR 结果缓存（内存 LRU + 可选磁盘层）"""
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[Path] = None, ttl: int = CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._last_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，先查内存层，再查磁盘层（命中后提升到内存层）"""
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        elif self.disk_dir is not None:
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None:
+                self._store(key, data)
+
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(data)
+
+    async def put(self, key: str, value: Dict[str, Any]):
+        """写入缓存，磁盘层在线程中写入"""
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self._store(key, data)
+        if self.disk_dir is not None:
+            await asyncio.to_thread(self._write_disk, key, data)
+            if time.time() - self._last_sweep > DISK_SWEEP_INTERVAL:
+                self._last_sweep = time.time()
+                asyncio.get_running_loop().run_in_executor(None, self._sweep_disk)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计信息"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk": str(self.disk_dir) if self.disk_dir is not None else None,
+        }
+
+    def _store(self, key: str, data: bytes):
+        """写入内存层，超过字节上限时按 LRU 淘汰"""
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._disk_path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"读取缓存文件失败 {path}: {e}")
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        path = self._disk_path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path.write_bytes(data)
+            # 原子替换，避免其他 worker 读到写了一半的文件
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入缓存文件失败 {path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    def _sweep_disk(self):
+        """删除磁盘层中已过期的条目"""
+        deadline = time.time() - self.ttl
+        removed = 0
+        for path in self.disk_dir.glob("*/*.json"):
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            logger.info(f"清理过期缓存文件 {removed} 个")
+
+
+# 全局结果缓存实例，未启用时为 None
+result_cache: Optional[OCRResultCache] = (
+    OCRResultCache(CACHE_MAX_BYTES, Path(CACHE_DIR) if CACHE_DIR else None, CACHE_TTL)
+    if CACHE_ENABLED else None
+)
@@ -2,8 +2,9 @@
 OCR 业务逻辑服务
 """
 import time
+import asyncio
 import logging
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, AsyncIterator
 from pathlib import Path
 from io import BytesIO
 import sys
@@ -16,20 +17,35 @@ from vllm import SamplingParams
 sys.path.append('/app/DeepSeek-OCR-vllm')
 
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.image_process import ResolutionProfile, count_image_tokens
 from app.core.lifespan import get_engine, get_processor
+from app.core.tracing import span, record_span, engine_request_id
+from app.services.cache_service import result_cache, make_result_key, file_digest, image_digest
+from app.services.single_flight import SingleFlight
+from app.services.scheduler import ocr_scheduler
+from app.services.preprocess_pool import decode_image, tokenize_image
 from app.core.config import (
-    RESOLUTION_CONFIGS, TASK_PROMPTS, OUTPUT_DIR, BASE_SIZE, IMAGE_SIZE, CROP_MODE
+    RESOLUTION_CONFIGS, TASK_PROMPTS, OUTPUT_DIR, BASE_SIZE, IMAGE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS
 )
 from app.utils.image_utils import (
-    load_image, re_match, parse_blocks_with_text, draw_bounding_boxes,
-    convert_matches_to_results
+    re_match, parse_blocks_with_text, draw_bounding_boxes, convert_matches_to_results
 )
 
 logger = logging.getLogger(__name__)
 
+# 图片尺寸未知时（如批量接口中尚未解码的图片）用于估算成本的尺寸：A4 页面按 2 倍渲染
+DEFAULT_IMAGE_SIZE = (1190, 1684)
 
-async def stream_generate(image=None, prompt=''):
-    """使用全局引擎进行推理"""
+# 合并相同图片、相同参数的在途识别请求（只合并引擎调用，调度槽位由每个请求各自获取）
+inflight_requests = SingleFlight()
+
+
+async def iter_generate(image=None, prompt='', profile: Optional[ResolutionProfile] = None):
+    """使用全局引擎进行推理，逐步产出新增的文本片段
+
+    profile 为图片预处理时使用的分辨率参数，通过 mm_processor_kwargs 传给引擎的多模态处理器，
+    使视觉 token 数与预处理结果一致。
+    """
     engine = get_engine()
     
     if engine is None:
@@ -48,7 +64,8 @@ async def stream_generate(image=None, prompt=''):
         skip_special_tokens=False,
     )
 
-    request_id = f"request-{int(time.time())}"
+    # 每个引擎请求使用唯一 ID（以 HTTP 请求 ID 为前缀），取消时按 ID 中止
+    request_id = engine_request_id()
 
     printed_length = 0
 
@@ -57,6 +74,8 @@ async def stream_generate(image=None, prompt=''):
             "prompt": prompt,
             "multi_modal_data": {"image": image}
         }
+        if profile is not None:
+            request["mm_processor_kwargs"] = profile.to_kwargs()
     elif prompt:
         request = {
             "prompt": prompt
@@ -64,18 +83,201 @@ async def stream_generate(image=None, prompt=''):
     else:
         raise ValueError('prompt is none!!!')
     
-    async for request_output in engine.generate(
-        request, sampling_params, request_id
-    ):
-        if request_output.outputs:
-            full_text = request_output.outputs[0].text
-            new_text = full_text[printed_length:]
-            print(new_text, end='', flush=True)
-            printed_length = len(full_text)
-            final_output = full_text
+    finished = False
+    submitted_at = time.perf_counter()
+    first_token_at = None
+    try:
+        async for request_output in engine.generate(
+            request, sampling_params, request_id
+        ):
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                record_span("ttft", first_token_at - submitted_at)
+            if request_output.outputs:
+                full_text = request_output.outputs[0].text
+                new_text = full_text[printed_length:]
+                printed_length = len(full_text)
+                if new_text:
+                    yield new_text
+        finished = True
+    finally:
+        if first_token_at is not None:
+            record_span("generate", time.perf_counter() - first_token_at)
+        if not finished:
+            # 调用方取消、客户端断开或出错：中止引擎中的请求，停止解码并释放 KV cache
+            logger.info(f"中止引擎请求 {request_id}")
+            await engine.abort(request_id)
+
+
+async def stream_generate(image=None, prompt='', profile: Optional[ResolutionProfile] = None):
+    """使用全局引擎进行推理，返回完整输出文本"""
+    chunks = []
+    async for new_text in iter_generate(image, prompt, profile):
+        print(new_text, end='', flush=True)
+        chunks.append(new_text)
     print('\n')
 
-    return final_output
+    return ''.join(chunks)
+
+
+def build_prompt(task_type: str, reference_text: Optional[str] = None) -> str:
+    """根据任务类型生成提示词"""
+    if task_type == "locate_object" and reference_text:
+        return TASK_PROMPTS[task_type].format(reference_text=reference_text)
+    if task_type in TASK_PROMPTS:
+        return TASK_PROMPTS[task_type]
+    # 将 task_type 作为自定义提示词使用
+    return task_type
+
+
+# 各分辨率模式对应的不可变预处理参数：预处理时传给 tokenize_with_images（不修改共享的处理器），
+# 推理时作为 mm_processor_kwargs 传给引擎，视觉 token 数随分辨率模式变化
+RESOLUTION_PROFILES = {
+    name: ResolutionProfile(
+        base_size=config["base_size"],
+        image_size=config["image_size"],
+        crop_mode=config["crop_mode"],
+        min_crops=MIN_CROPS,
+        max_crops=MAX_CROPS,
+    )
+    for name, config in RESOLUTION_CONFIGS.items()
+}
+
+
+def get_resolution_profile(resolution: str) -> ResolutionProfile:
+    """获取分辨率模式的预处理参数，未知模式按 gundam 处理"""
+    return RESOLUTION_PROFILES.get(resolution, RESOLUTION_PROFILES["gundam"])
+
+
+def estimate_vision_tokens(width: int, height: int, resolution: str) -> int:
+    """估算图片在指定分辨率下的视觉 token 数（与 DeepseekOCRProcessor 的分块规则一致，按尺寸缓存），用作调度成本"""
+    return count_image_tokens(width, height, get_resolution_profile(resolution))
+
+
+async def prepare_image_features(image: Image.Image, prompt: str, resolution: str):
+    """按分辨率配置对图片进行预处理与分词，返回送入引擎的图像特征
+
+    预处理在预处理进程池中执行（未启用时在线程中执行），不阻塞事件循环。
+    """
+    if '<image>' not in prompt:
+        return ''
+
+    processor = get_processor()
+    if processor is None:
+        raise Exception("Processor not initialized")
+
+    with span("tokenize"):
+        return await tokenize_image(image, get_resolution_profile(resolution), processor, prompt)
+
+
+def postprocess_output(result_out: str, image: Image.Image) -> Tuple[str, list]:
+    """解析模型输出，返回处理后文本与矩形结果"""
+    with span("parse"):
+        # 解析检测框与对应文本
+        matches_ref, matches_images, matches_other = re_match(result_out)
+        blocks = parse_blocks_with_text(result_out)
+        contents = [b.get('content', '') for b in blocks]
+        results = convert_matches_to_results(matches_ref, image.size[0], image.size[1], contents)
+
+    # 生成 processed_text（替换图片占位）
+    processed_text = result_out
+    for idx, a_match_image in enumerate(matches_images):
+        processed_text = processed_text.replace(a_match_image, f'![](images/{idx}.jpg)\n')
+    for a_match_other in matches_other:
+        processed_text = processed_text.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+    return processed_text, results
+
+
+async def lookup_cached_result(
+    digest: str, task_type: str, resolution: str, prompt: str
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """计算结果键并查询结果缓存，返回 (结果键, 缓存条目)；未命中或未启用缓存时条目为 None"""
+    result_key = make_result_key(digest, task_type, resolution, prompt)
+    if result_cache is None:
+        return result_key, None
+    return result_key, await result_cache.get(result_key)
+
+
+async def find_cached_result(
+    digest: str, task_type: str = "markdown", resolution: str = "gundam"
+) -> Tuple[str, Optional[Tuple[str, str, list]]]:
+    """在解码图片之前按图片字节的哈希（file_digest / raw_pixels_digest）查询结果缓存
+
+    返回 (结果键, (原始文本, 处理后文本, 矩形结果))，未命中时结果为 None；
+    未命中时将结果键传给 run_deepseek_on_pil / stream_deepseek_on_pil，不再重复查询。
+    """
+    result_key, cached = await lookup_cached_result(digest, task_type, resolution, build_prompt(task_type))
+    if cached is None:
+        return result_key, None
+    return result_key, (cached["text"], cached["processed_text"], cached["results"])
+
+
+async def iter_cached_result(cached: Tuple[str, str, list]) -> AsyncIterator[Tuple[str, Any]]:
+    """以 stream_deepseek_on_pil 的事件格式一次性产出缓存结果"""
+    yield "delta", cached[0]
+    yield "result", cached
+
+
+async def store_cached_result(result_key: str, result_out: str, processed_text: str, results: list):
+    """将识别结果写入结果缓存"""
+    if result_cache is None:
+        return
+    await result_cache.put(result_key, {
+        "text": result_out,
+        "processed_text": processed_text,
+        "results": results
+    })
+
+
+async def recognize(
+    image: Image.Image, prompt: str, resolution: str, result_key: str
+) -> Tuple[str, str, list]:
+    """预处理、推理并解析一张图片，结果写入缓存，返回原始文本、处理后文本、矩形结果
+
+    调用方需已持有调度器分配的槽位（通过 recognize_coalesced 调用）。
+    """
+    image_features = await prepare_image_features(image, prompt, resolution)
+
+    result_out = await stream_generate(image_features, prompt, get_resolution_profile(resolution))
+
+    processed_text, results = postprocess_output(result_out, image)
+    await store_cached_result(result_key, result_out, processed_text, results)
+    return result_out, processed_text, results
+
+
+async def recognize_coalesced(
+    image: Image.Image, prompt: str, resolution: str, result_key: str
+) -> Tuple[str, str, list]:
+    """在调度槽位内识别一张图片，相同结果键的在途请求合并为一次引擎调用
+
+    每个请求按自己的优先级、客户端份额与截止时间排队获取槽位（已持有槽位时直接进入），
+    获得槽位后只共享预处理与推理：共享任务在已持有槽位的上下文中执行，不再排队，
+    因此合并不受各请求调度身份的影响。排队期间相同请求已完成时直接使用缓存结果。
+    """
+    async with ocr_scheduler.slot(cost=estimate_vision_tokens(*image.size, resolution)):
+        if result_cache is not None:
+            cached = await result_cache.get(result_key)
+            if cached is not None:
+                return cached["text"], cached["processed_text"], cached["results"]
+        return await inflight_requests.do(
+            result_key, lambda: recognize(image, prompt, resolution, result_key)
+        )
+
+
+def _save_visualization(image: Image.Image, matches_ref: list, output_path: Path):
+    """绘制检测框并保存可视化结果（在线程中执行）"""
+    result_image = draw_bounding_boxes(image, matches_ref, output_path)
+    result_image.save(output_path / "result_with_boxes.jpg")
+
+
+async def _load_task_image(image_path: Path) -> Image.Image:
+    """加载任务图片（在预处理进程池中解码）"""
+    try:
+        with span("image_decode"):
+            return await decode_image(image_path)
+    except Exception as e:
+        raise Exception(f"Failed to load image: {e}")
 
 
 async def process_ocr_task(
@@ -88,54 +290,19 @@ async def process_ocr_task(
 ):
     """处理OCR任务 - 支持动态配置"""
     try:
-        # 加载图片
-        image = load_image(image_path)
-        if image is None:
-            raise Exception("Failed to load image")
-        
         # 根据任务类型生成提示词
-        if task_type == "locate_object" and reference_text:
-            prompt = TASK_PROMPTS[task_type].format(reference_text=reference_text)
-        elif task_type in TASK_PROMPTS:
-            prompt = TASK_PROMPTS[task_type]
-        else:
-            # 将 task_type 作为自定义提示词使用
-            prompt = task_type
+        prompt = build_prompt(task_type, reference_text)
         
-        # 根据分辨率配置动态调整参数
-        resolution_config = RESOLUTION_CONFIGS.get(resolution, RESOLUTION_CONFIGS["gundam"])
-        
-        processor = get_processor()
-        if processor is None:
-            raise Exception("Processor not initialized")
-        
-        # 临时更新 processor 的实例变量以使用新的分辨率配置
-        original_image_size = processor.image_size
-        original_base_size = processor.base_size
-        
-        processor.image_size = resolution_config["image_size"]
-        processor.base_size = resolution_config["base_size"]
-        crop_mode = resolution_config["crop_mode"]
-        
-        try:
-            # 处理图片
-            if '<image>' in prompt:
-                image_features = processor.tokenize_with_images(
-                    images=[image], 
-                    bos=True, 
-                    eos=True, 
-                    cropping=crop_mode
-                )
-            else:
-                image_features = ''
-            
-            # 调用stream_generate
-            result_out = await stream_generate(image_features, prompt)
-            
-        finally:
-            # 恢复原始配置
-            processor.image_size = original_image_size
-            processor.base_size = original_base_size
+        # 按上传文件的编码字节查询结果缓存，命中时跳过解码、预处理与推理；
+        # 相同的在途请求合并为一次推理
+        digest = await asyncio.to_thread(file_digest, image_path)
+        result_key, cached = await lookup_cached_result(digest, task_type, resolution, prompt)
+        image = None
+        if cached is not None:
+            result_out = cached["text"]
+        else:
+            image = await _load_task_image(image_path)
+            result_out, _, _ = await recognize_coalesced(image, prompt, resolution, result_key)
         
         # 处理结果
         result = {
@@ -156,12 +323,15 @@ async def process_ocr_task(
                 f.write(result_out)
             
             # 解析边界框
-            matches_ref, matches_images, matches_other = re_match(result_out)
+            with span("parse"):
+                matches_ref, matches_images, matches_other = re_match(result_out)
             
-            # 绘制边界框
+            # 绘制边界框（命中缓存时此时才解码图片）
             if matches_ref:
-                result_image = draw_bounding_boxes(image, matches_ref, output_path)
-                result_image.save(output_path / "result_with_boxes.jpg")
+                if image is None:
+                    image = await _load_task_image(image_path)
+                with span("visualize"):
+                    await asyncio.to_thread(_save_visualization, image, matches_ref, output_path)
                 result["visualization_path"] = f"/deepseek-ocr/outputs/{task_id}/result_with_boxes.jpg"
             
             # 处理markdown结果
@@ -195,62 +365,56 @@ async def process_ocr_task(
 async def run_deepseek_on_pil(
     image: Image.Image, 
     task_type: str = "markdown", 
-    resolution: str = "gundam"
+    resolution: str = "gundam",
+    result_key: Optional[str] = None
 ) -> Tuple[str, str, list]:
-    """对 PIL.Image 运行 DeepSeek OCR，返回原始文本、处理后文本、矩形结果。"""
-    # 生成提示词
-    if task_type in TASK_PROMPTS:
-        prompt = TASK_PROMPTS[task_type]
-    else:
-        # 将 task_type 作为自定义提示词使用
-        prompt = task_type
-    
-    # 根据分辨率配置动态调整参数
-    resolution = resolution if resolution in RESOLUTION_CONFIGS else "gundam"
-    resolution_config = RESOLUTION_CONFIGS[resolution]
+    """对 PIL.Image 运行 DeepSeek OCR，返回原始文本、处理后文本、矩形结果。
 
-    processor = get_processor()
-    if processor is None:
-        raise Exception("Processor not initialized")
-    
-    # 临时更新 processor 的实例变量
-    original_image_size = processor.image_size
-    original_base_size = processor.base_size
-    
-    processor.image_size = resolution_config["image_size"]
-    processor.base_size = resolution_config["base_size"]
-    crop_mode = resolution_config["crop_mode"]
+    result_key 为调用方在解码前由 find_cached_result 得到的结果键（此时已确认未命中缓存）；
+    未提供时按像素内容计算结果键并查询缓存。
+    """
+    prompt = build_prompt(task_type)
+    if result_key is None:
+        digest = await asyncio.to_thread(image_digest, image)
+        result_key, cached = await lookup_cached_result(digest, task_type, resolution, prompt)
+        if cached is not None:
+            return cached["text"], cached["processed_text"], cached["results"]
 
-    try:
-        # 处理图像
-        if '<image>' in prompt:
-            image_features = processor.tokenize_with_images(
-                images=[image], 
-                bos=True, 
-                eos=True, 
-                cropping=crop_mode
-            )
-        else:
-            image_features = ''
+    return await recognize_coalesced(image, prompt, resolution, result_key)
 
-        result_out = await stream_generate(image_features, prompt)
-    finally:
-        # 恢复原始配置
-        processor.image_size = original_image_size
-        processor.base_size = original_base_size
 
-    # 解析检测框与对应文本
-    matches_ref, matches_images, matches_other = re_match(result_out)
-    blocks = parse_blocks_with_text(result_out)
-    contents = [b.get('content', '') for b in blocks]
-    results = convert_matches_to_results(matches_ref, image.size[0], image.size[1], contents)
+async def stream_deepseek_on_pil(
+    image: Image.Image,
+    task_type: str = "markdown",
+    resolution: str = "gundam",
+    result_key: Optional[str] = None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """对 PIL.Image 流式运行 DeepSeek OCR。
 
-    # 生成 processed_text（替换图片占位）
-    processed_text = result_out
-    for idx, a_match_image in enumerate(matches_images):
-        processed_text = processed_text.replace(a_match_image, f'![](images/{idx}.jpg)\n')
-    for a_match_other in matches_other:
-        processed_text = processed_text.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+    依次产出 ("delta", 新增文本)，最后产出
+    ("result", (原始文本, 处理后文本, 矩形结果))。
+    命中结果缓存时一次性产出完整文本。result_key 同 run_deepseek_on_pil。
+    """
+    prompt = build_prompt(task_type)
+    if result_key is None:
+        digest = await asyncio.to_thread(image_digest, image)
+        result_key, cached = await lookup_cached_result(digest, task_type, resolution, prompt)
+        if cached is not None:
+            async for event in iter_cached_result(
+                (cached["text"], cached["processed_text"], cached["results"])
+            ):
+                yield event
+            return
 
-    return result_out, processed_text, results
+    chunks = []
+    async with ocr_scheduler.slot(cost=estimate_vision_tokens(*image.size, resolution)):
+        image_features = await prepare_image_features(image, prompt, resolution)
+
+        async for new_text in iter_generate(image_features, prompt, get_resolution_profile(resolution)):
+            chunks.append(new_text)
+            yield "delta", new_text
 
+    result_out = ''.join(chunks)
+    processed_text, results = postprocess_output(result_out, image)
+    await store_cached_result(result_key, result_out, processed_text, results)
+    yield "result", (result_out, processed_text, results)
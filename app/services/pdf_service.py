@@ -0,0 +1,120 @@
+"""
+PDF OCR 业务逻辑服务
+"""
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Any, Optional
+
+from PIL import Image
+
+from app.services.ocr_service import run_deepseek_on_pil, estimate_vision_tokens
+from app.services.scheduler import Backlog
+from app.core.tracing import span
+from app.core.config import PDF_PAGE_CONCURRENCY, PDF_RENDER_ZOOM
+
+logger = logging.getLogger(__name__)
+
+
+def render_pdf_page(doc, page_index: int) -> Image.Image:
+    """将 PDF 的一页渲染为 RGB 图像（避免依赖提取内嵌图片能力）"""
+    import fitz  # PyMuPDF
+
+    page = doc[page_index]
+    # 放大渲染，清晰些；默认 alpha=False，samples 即紧密排列的 RGB 像素，无需 PNG 编解码
+    pix = page.get_pixmap(matrix=fitz.Matrix(PDF_RENDER_ZOOM, PDF_RENDER_ZOOM))
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def estimate_page_tokens(doc, resolution: str) -> int:
+    """按首页渲染尺寸估算单页的视觉 token 数（不渲染页面）"""
+    rect = doc[0].rect
+    return estimate_vision_tokens(
+        int(rect.width * PDF_RENDER_ZOOM), int(rect.height * PDF_RENDER_ZOOM), resolution
+    )
+
+
+async def iter_pdf_page_results(
+    doc,
+    task_type: str = "markdown",
+    resolution: str = "gundam",
+    concurrency: Optional[int] = None,
+    backlog: Optional[Backlog] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """流水线式识别 PDF 的每一页，按完成顺序产出页面结果
+
+    - 渲染在线程中串行进行（PyMuPDF 文档对象不支持并发访问），不阻塞事件循环
+    - 每渲染完一页立即提交给引擎，最多同时有 concurrency 页在识别中，
+      使 AsyncLLMEngine 可以对同一文档的多页进行连续批处理
+    - 已完成的页面结果最多缓存 concurrency 个，调用方（如流式响应的客户端）读取较慢时，
+      识别中的页面在放入结果时等待，生产者随之停止渲染新页面（背压），内存占用不随页数增长
+    - 任意一页失败时取消其余页面并抛出异常
+    - backlog 为准入时登记的积压（ocr_scheduler.admit_backlog），每页提交时扣减，结束时关闭
+    """
+    concurrency = max(1, min(concurrency or PDF_PAGE_CONCURRENCY, PDF_PAGE_CONCURRENCY))
+    page_count = len(doc)
+    slots = asyncio.Semaphore(concurrency)
+    done: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    page_tasks = []
+    stopped = asyncio.Event()
+
+    async def run_page(page_index: int, pil_image: Image.Image):
+        try:
+            page_start = time.time()
+            if backlog is not None:
+                backlog.take()
+            text, processed_text, results = await run_deepseek_on_pil(pil_image, task_type, resolution)
+            page_elapsed = time.time() - page_start
+            width, height = pil_image.size
+            await done.put({
+                "page": page_index + 1,
+                "index": 0,
+                "result": results,
+                "bbox_image": [0, 0, width, height],
+                "processing_time": round(page_elapsed, 4),
+                "image_size": {"width": width, "height": height},
+                "text": text,
+                "processed_text": processed_text
+            })
+        except Exception as e:
+            await done.put(e)
+        finally:
+            slots.release()
+
+    async def produce():
+        for page_index in range(page_count):
+            await slots.acquire()
+            if stopped.is_set():
+                slots.release()
+                return
+            try:
+                with span("image_decode"):
+                    pil_image = await asyncio.to_thread(render_pdf_page, doc, page_index)
+            except Exception as e:
+                slots.release()
+                await done.put(e)
+                return
+            if stopped.is_set():
+                slots.release()
+                return
+            page_tasks.append(asyncio.create_task(run_page(page_index, pil_image)))
+
+    producer = asyncio.create_task(produce())
+    try:
+        for _ in range(page_count):
+            item = await done.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # 不直接取消生产者：渲染线程无法中断，需等它结束后调用方才能安全关闭文档
+        stopped.set()
+        if backlog is not None:
+            backlog.close()
+        for task in page_tasks:
+            task.cancel()
+        await asyncio.gather(*page_tasks, return_exceptions=True)
+        # 生产者可能正阻塞在向已满队列放入渲染错误上，清空未读取的结果使其退出
+        while not done.empty():
+            done.get_nowait()
+        await asyncio.gather(producer, return_exceptions=True)
@@ -0,0 +1,280 @@
+"""
+CPU 预处理进程池
+
+图片解码（含 EXIF 方向校正）与 tokenize_with_images（分块、缩放、归一化、分词）都是 CPU 密集型操作，
+在事件循环中执行会阻塞所有请求（包括健康检查），在线程中执行又受 GIL 限制。
+这里把它们放到 NUM_WORKERS 个子进程中执行：
+
+- 子进程以 spawn 方式启动（父进程已初始化 CUDA，不能 fork），各自持有一个 DeepseekOCRProcessor
+- 像素与张量通过共享内存传递，进程间管道只传递共享内存名称、形状与 dtype，
+  避免对数十 MB 的张量做 pickle 序列化
+- 共享内存由接收方读取后释放；请求在子进程执行期间被取消时，结果到达后立即释放
+- 解码前只读取图片头检查像素数（OCR_MAX_IMAGE_PIXELS），超大图片 / 解压炸弹不会被解码
+- 子进程异常退出（如 OOM 被杀、解码器崩溃）后进程池不可再用：当时在子进程中执行的请求失败，
+  进程池在锁内重建，之后的请求不受影响
+- NUM_WORKERS=0 时不启用进程池，改为在线程中执行（处理器无共享状态，多个线程可并发使用）
+"""
+import io
+import asyncio
+import logging
+import threading
+import concurrent.futures
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Any, BinaryIO, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.core.config import NUM_WORKERS, UPLOAD_CHUNK_SIZE
+from app.utils.image_utils import check_image_pixels
+
+logger = logging.getLogger(__name__)
+
+# 共享内存中的一组数组：(共享内存名称, [(形状, dtype, 偏移), ...])
+SharedArrays = Tuple[str, List[Tuple[Tuple[int, ...], str, int]]]
+
+# 子进程内的处理器实例
+_worker_processor = None
+
+# 父进程中的进程池，未启用时为 None
+_pool: Optional[ProcessPoolExecutor] = None
+# 重建进程池时持有，多个请求同时发现进程池损坏时只重建一次
+_pool_lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# 共享内存打包 / 解包（父进程与子进程共用）
+# ---------------------------------------------------------------------------
+
+def _pack_arrays(arrays: Sequence[np.ndarray]) -> SharedArrays:
+    """将多个数组连续写入一块新的共享内存"""
+    layout, offset = [], 0
+    for array in arrays:
+        layout.append((array.shape, array.dtype.str, offset))
+        # 按 64 字节对齐，便于解包后的视图直接用于向量化运算
+        offset += (array.nbytes + 63) // 64 * 64
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for array, (shape, dtype, start) in zip(arrays, layout):
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = array
+        return shm.name, layout
+    finally:
+        shm.close()
+
+
+def _unpack_arrays(packed: SharedArrays, unlink: bool = True) -> List[np.ndarray]:
+    """从共享内存复制出数组，默认随后释放共享内存"""
+    name, layout = packed
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return [
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start).copy()
+            for shape, dtype, start in layout
+        ]
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _release(packed: Optional[SharedArrays]):
+    """释放未被读取的共享内存"""
+    if packed is None:
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=packed[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+# ---------------------------------------------------------------------------
+# 子进程
+# ---------------------------------------------------------------------------
+
+def _init_worker():
+    """子进程初始化：创建处理器（加载 tokenizer）
+
+    spawn 启动的子进程继承父进程的 sys.path，可以直接导入 DeepSeek-OCR-vllm 中的模块。
+    """
+    global _worker_processor
+    from process.image_process import DeepseekOCRProcessor
+    _worker_processor = DeepseekOCRProcessor()
+
+
+def _decode_image(fp) -> Image.Image:
+    """解码图片并按 EXIF 方向校正；像素数超过上限时不解码"""
+    image = Image.open(fp)
+    check_image_pixels(image)
+    return ImageOps.exif_transpose(image).convert("RGB")
+
+
+def _worker_decode(source: Union[str, SharedArrays]) -> Tuple[SharedArrays, None]:
+    """在子进程中解码图片（文件路径，或共享内存中的编码字节），像素写回共享内存"""
+    if isinstance(source, str):
+        image = _decode_image(source)
+    else:
+        encoded, = _unpack_arrays(source)
+        image = _decode_image(io.BytesIO(encoded.tobytes()))
+    return _pack_arrays([np.asarray(image)]), None
+
+
+def _tokenize(processor, image: Image.Image, profile, prompt: Optional[str]) -> list:
+    """按请求的分辨率参数与提示词调用 tokenize_with_images（不修改处理器，可并发调用）"""
+    return processor.tokenize_with_images(
+        images=[image], bos=True, eos=True, profile=profile, conversation=prompt
+    )
+
+
+def _worker_tokenize(
+    pixels: SharedArrays, profile, prompt: Optional[str]
+) -> Tuple[SharedArrays, Tuple[list, list]]:
+    """在子进程中预处理图片，张量写入共享内存，返回 (张量, (num_image_tokens, image_shapes))"""
+    array, = _unpack_arrays(pixels)
+    (input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop,
+     num_image_tokens, image_shapes), = _tokenize(_worker_processor, Image.fromarray(array), profile, prompt)
+    tensors = [input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop]
+    return _pack_arrays([tensor.numpy() for tensor in tensors]), (num_image_tokens, image_shapes)
+
+
+# ---------------------------------------------------------------------------
+# 父进程
+# ---------------------------------------------------------------------------
+
+def _create_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=NUM_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+def start_preprocess_pool():
+    """启动预处理进程池并预先创建全部子进程（NUM_WORKERS<=0 时不启用）"""
+    global _pool
+    if NUM_WORKERS <= 0 or _pool is not None:
+        return
+    _pool = _create_pool()
+    # 提前启动子进程并加载 tokenizer，避免首个请求承担启动开销
+    concurrent.futures.wait([_pool.submit(int) for _ in range(NUM_WORKERS)])
+    logger.info(f"预处理进程池已启动: {NUM_WORKERS} 个进程")
+
+
+def shutdown_preprocess_pool():
+    """关闭预处理进程池"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+        logger.info("预处理进程池已关闭")
+
+
+def _replace_broken_pool(broken: ProcessPoolExecutor):
+    """用新的进程池替换已损坏的进程池（子进程在下一次提交时启动）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:
+            # 已由其他请求重建，或进程池已关闭
+            return
+        _pool = _create_pool()
+    broken.shutdown(wait=False, cancel_futures=True)
+    logger.error("预处理子进程异常退出，已重建进程池")
+
+
+async def _run_in_pool(fn, *args) -> Tuple[SharedArrays, Any]:
+    """在进程池中执行 fn，返回 (共享内存中的数组, 附加结果)
+
+    - 等待期间被取消时，结果中的共享内存在结果到达后释放
+    - 提交时进程池已损坏（由之前的请求导致）：重建后重新提交
+    - 执行期间子进程异常退出：重建进程池，本请求失败（RuntimeError）
+    """
+    pool = _pool
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _replace_broken_pool(pool)
+        pool = _pool
+        future = pool.submit(fn, *args)
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(_release_result)
+        raise
+    except BrokenProcessPool as e:
+        _replace_broken_pool(pool)
+        raise RuntimeError("预处理子进程异常退出（图片可能过大或已损坏）") from e
+
+
+def _release_result(future: concurrent.futures.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    _release(future.result()[0])
+
+
+async def decode_image(source: Union[Path, BinaryIO]) -> Image.Image:
+    """解码图片并按 EXIF 方向校正，返回 RGB 图片
+
+    source 为文件路径，或上传文件对象（编码字节经共享内存传给子进程）。
+    """
+    if _pool is None:
+        return await asyncio.to_thread(_decode_image, source)
+
+    if isinstance(source, Path):
+        packed, _ = await _run_in_pool(_worker_decode, str(source))
+    else:
+        encoded = await asyncio.to_thread(_pack_file, source)
+        try:
+            packed, _ = await _run_in_pool(_worker_decode, encoded)
+        finally:
+            # 子进程读取后已释放，这里只处理子进程未执行的情况
+            _release(encoded)
+    array, = await asyncio.to_thread(_unpack_arrays, packed)
+    return Image.fromarray(array)
+
+
+def _pack_file(fileobj: BinaryIO) -> SharedArrays:
+    """将文件对象的内容写入共享内存（按块复制，不在内存中拼接整个文件）"""
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        position = 0
+        while chunk := fileobj.read(min(UPLOAD_CHUNK_SIZE, size - position)):
+            shm.buf[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return shm.name, [((position,), "|u1", 0)]
+    finally:
+        shm.close()
+
+
+async def tokenize_image(
+    image: Image.Image, profile, processor=None, prompt: Optional[str] = None
+) -> list:
+    """按 ResolutionProfile 与提示词预处理图片并分词，返回与 DeepseekOCRProcessor.tokenize_with_images 相同结构的结果
+
+    未启用进程池时在线程中使用 processor 执行。
+    """
+    if _pool is None:
+        return await asyncio.to_thread(_tokenize, processor, image, profile, prompt)
+
+    import torch
+
+    pixels = await asyncio.to_thread(_pack_arrays, [np.asarray(image)])
+    try:
+        packed, (num_image_tokens, image_shapes) = await _run_in_pool(
+            _worker_tokenize, pixels, profile, prompt
+        )
+    finally:
+        _release(pixels)
+    arrays = await asyncio.to_thread(_unpack_arrays, packed)
+    input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop = (
+        torch.from_numpy(array) for array in arrays
+    )
+    return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop,
+             num_image_tokens, image_shapes]]
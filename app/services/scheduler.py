@@ -0,0 +1,426 @@
+"""
+OCR 请求调度器
+
+决定哪个请求下一个进入引擎，替代按到达顺序放行的 asyncio.Semaphore：
+
+- 优先级：interactive（同步接口）> normal（/api/ocr 异步任务）> batch（批量 / PDF），
+  有高优先级请求排队时不调度低优先级请求
+- 同一优先级内按客户端加权公平排队（WFQ）：各客户端按权重分享容量，
+  单个客户端一次提交大量请求不会让其他客户端一直排在后面
+- 截止时间：请求排队超过截止时间后，按 OCR_DEADLINE_POLICY 丢弃（504）或降为 batch 优先级
+- 可查询排队位置与预计等待时间
+- 准入控制：按排队请求的视觉 token 成本与实测的每单位成本耗时估算排空时间，
+  超过 OCR_MAX_QUEUE_SECONDS 时拒绝新请求（429 + Retry-After）；
+  PDF / 批量请求按排在首页 / 首张图片前面的工作准入（不计文档自身的成本），
+  通过后尚未提交的部分登记为积压（Backlog），计入之后的估算
+
+请求的优先级、客户端与截止时间通过 bind_job_context 绑定到当前上下文，
+在服务层调用 ocr_scheduler.slot() 时读取，无需逐层传参。
+"""
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from enum import IntEnum
+from dataclasses import dataclass, field, replace
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+from app.core.config import SCHEDULER_CAPACITY, DEADLINE_POLICY, CLIENT_WEIGHTS, MAX_QUEUE_SECONDS
+from app.core.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# 每单位成本耗时的指数滑动平均系数
+SERVICE_TIME_SMOOTHING = 0.1
+
+# 单个优先级队列中记录的客户端数超过该值时清理已落后于虚拟时间的客户端
+MAX_TRACKED_CLIENTS = 1024
+
+
+class Priority(IntEnum):
+    """优先级，数值越小越优先"""
+    INTERACTIVE = 0
+    NORMAL = 1
+    BATCH = 2
+
+
+@dataclass(frozen=True)
+class JobContext:
+    """请求的调度属性"""
+    priority: Priority = Priority.NORMAL
+    client_id: str = "anonymous"
+    deadline: Optional[float] = None  # time.time() 时间戳
+    job_id: Optional[str] = None  # 用于查询排队位置（如 /api/ocr 的 task_id）
+
+
+class DeadlineExceeded(HTTPException):
+    """请求排队超过截止时间"""
+
+    def __init__(self, waited: float):
+        super().__init__(status_code=504, detail=f"请求排队 {waited:.1f}s 后超过截止时间，已取消")
+
+
+class QueueFull(HTTPException):
+    """预计排队时间超过上限，拒绝新请求"""
+
+    def __init__(self, drain_time: float, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=f"服务繁忙，预计排队 {drain_time:.0f}s，请 {retry_after}s 后重试",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+
+current_job: ContextVar[JobContext] = ContextVar("current_job", default=JobContext())
+# 当前上下文是否已持有调度槽位（同一请求内嵌套调用 slot() 时不重复排队）
+_holding_slot: ContextVar[bool] = ContextVar("holding_slot", default=False)
+
+
+def parse_client_weights(spec: str) -> Dict[str, float]:
+    """解析 "client=weight,..." 格式的客户端权重"""
+    weights = {}
+    for item in spec.split(","):
+        client_id, sep, weight = item.strip().partition("=")
+        if not sep:
+            continue
+        try:
+            weights[client_id.strip()] = max(float(weight), 1e-3)
+        except ValueError:
+            logger.warning(f"忽略无效的客户端权重配置: {item}")
+    return weights
+
+
+def bind_job_context(
+    request: Request, default_priority: Priority, job_id: Optional[str] = None
+) -> JobContext:
+    """根据请求头设置当前请求的调度属性
+
+    - X-Priority: interactive / normal / batch，只能在接口默认优先级的基础上降低
+    - X-Client-Id: 公平排队使用的客户端标识，默认使用客户端 IP
+    - X-Request-Timeout: 截止时间（秒，自请求到达起计算）
+    """
+    headers = request.headers
+    priority = default_priority
+    requested = headers.get("x-priority", "").strip().upper()
+    if requested in Priority.__members__:
+        priority = max(default_priority, Priority[requested])
+
+    client_id = headers.get("x-client-id") or (request.client.host if request.client else "anonymous")
+
+    deadline = None
+    timeout = headers.get("x-request-timeout")
+    if timeout:
+        try:
+            deadline = time.time() + float(timeout)
+        except ValueError:
+            logger.warning(f"忽略无效的 X-Request-Timeout: {timeout}")
+
+    context = JobContext(priority=priority, client_id=client_id, deadline=deadline, job_id=job_id)
+    current_job.set(context)
+    return context
+
+
+class Backlog:
+    """已准入、尚未进入调度队列的一组请求（如 PDF 中等待提交的页面），计入排空时间估算
+
+    每个请求进入调度队列前调用 take()，此后其成本由队列中的条目计入；结束时调用 close()。
+    """
+
+    def __init__(self, priority: Priority, count: int, unit_cost: float):
+        self.priority = priority
+        self.remaining = count
+        self.unit_cost = unit_cost
+
+    @property
+    def cost(self) -> float:
+        return self.remaining * self.unit_cost
+
+    def take(self):
+        """一个请求开始提交"""
+        self.remaining = max(0, self.remaining - 1)
+
+    def close(self):
+        """剩余的请求不再提交（全部完成、出错或被取消）"""
+        self.remaining = 0
+
+
+@dataclass(order=True)
+class _Job:
+    finish: float
+    seq: int
+    start: float = field(compare=False)
+    priority: Priority = field(compare=False)
+    context: JobContext = field(compare=False)
+    cost: float = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    # 被降级后原队列中的条目作废，由新条目代替
+    superseded: bool = field(default=False, compare=False)
+    timer: Optional[asyncio.TimerHandle] = field(default=None, compare=False)
+
+    @property
+    def waiting(self) -> bool:
+        return not self.superseded and not self.future.done()
+
+
+class _FairQueue:
+    """单个优先级内的加权公平队列（按虚拟完成时间排序）"""
+
+    def __init__(self):
+        self.heap: List[_Job] = []
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+
+    def tags(self, client_id: str, cost: float, weight: float) -> Tuple[float, float]:
+        """计算新请求的虚拟开始 / 完成时间"""
+        start = max(self.virtual_time, self.last_finish.get(client_id, 0.0))
+        finish = start + cost / weight
+        self.last_finish[client_id] = finish
+        return start, finish
+
+    def push(self, job: _Job):
+        heapq.heappush(self.heap, job)
+
+    def pop(self) -> Optional[_Job]:
+        while self.heap:
+            job = heapq.heappop(self.heap)
+            if job.waiting:
+                self.virtual_time = max(self.virtual_time, job.start)
+                if len(self.last_finish) > MAX_TRACKED_CLIENTS:
+                    self.last_finish = {
+                        client_id: finish for client_id, finish in self.last_finish.items()
+                        if finish > self.virtual_time
+                    }
+                return job
+        return None
+
+
+class OCRScheduler:
+    """按优先级与客户端加权公平性分配引擎并发槽位"""
+
+    def __init__(
+        self,
+        capacity: int,
+        deadline_policy: str = "drop",
+        client_weights: Optional[Dict[str, float]] = None,
+        max_queue_seconds: float = 0
+    ):
+        self.capacity = max(1, capacity)
+        self.deadline_policy = deadline_policy
+        self.client_weights = client_weights or {}
+        self.max_queue_seconds = max_queue_seconds
+        self.active = 0
+        self.active_cost = 0.0
+        # 实测的每单位成本（视觉 token）占用槽位的时间，尚无样本时为 None
+        self.seconds_per_cost: Optional[float] = None
+        self.dropped = 0
+        self.rejected = 0
+        self._queues = {priority: _FairQueue() for priority in Priority}
+        self._backlogs: List[Backlog] = []
+        self._jobs: Dict[str, _Job] = {}
+        self._seq = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, cost: float = 1.0):
+        """获取一个引擎槽位，退出时释放；同一上下文中已持有槽位时直接进入
+
+        cost 为请求的相对成本（视觉 token 数），用于公平排队与排队时间估算。
+        """
+        if _holding_slot.get():
+            yield
+            return
+
+        with span("queue"):
+            await self._acquire(cost)
+        _holding_slot.set(True)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            _holding_slot.set(False)
+            self._release(cost, time.monotonic() - started)
+
+    def estimate_drain_time(self, priority: Priority, extra_cost: float = 0.0) -> Optional[float]:
+        """估算优先级不低于 priority 的已有请求（加上 extra_cost）全部完成所需时间（秒）"""
+        if self.seconds_per_cost is None:
+            return None
+        backlog = self.active_cost + extra_cost + self.backlog_cost(priority) + sum(
+            job.cost
+            for queued_priority, queue in self._queues.items()
+            if queued_priority <= priority
+            for job in queue.heap
+            if job.waiting
+        )
+        return backlog * self.seconds_per_cost / self.capacity
+
+    def backlog_cost(self, priority: Priority = Priority.BATCH) -> float:
+        """优先级不低于 priority 的积压中尚未提交的成本"""
+        self._backlogs = [backlog for backlog in self._backlogs if backlog.remaining]
+        return sum(backlog.cost for backlog in self._backlogs if backlog.priority <= priority)
+
+    def admit(self, cost: float, priority: Optional[Priority] = None):
+        """准入控制：预计排队时间超过 OCR_MAX_QUEUE_SECONDS 时抛出 QueueFull（429）"""
+        if self.max_queue_seconds <= 0:
+            return
+        if priority is None:
+            priority = current_job.get().priority
+        drain_time = self.estimate_drain_time(priority, cost)
+        if drain_time is None or drain_time <= self.max_queue_seconds:
+            return
+        self.rejected += 1
+        retry_after = max(1, math.ceil(drain_time - self.max_queue_seconds))
+        logger.warning(
+            f"拒绝新请求 | client: {current_job.get().client_id} | 优先级: {priority.name.lower()} | "
+            f"预计排队 {drain_time:.1f}s > {self.max_queue_seconds}s"
+        )
+        raise QueueFull(drain_time, retry_after)
+
+    def admit_backlog(self, count: int, unit_cost: float, priority: Optional[Priority] = None) -> Backlog:
+        """准入一组请求（如 PDF 的全部页面），通过后登记为积压
+
+        准入只计入排在第一个请求前面的工作（已有队列、执行中的请求与其他积压）加上一个请求的成本：
+        若计入整组成本，自身成本超过 OCR_MAX_QUEUE_SECONDS 的文档在空闲时也会被拒绝，重试永远不会成功。
+        """
+        if priority is None:
+            priority = current_job.get().priority
+        self.admit(unit_cost, priority)
+        backlog = Backlog(priority, count, unit_cost)
+        # 顺便移除已结束的积压（未启用准入控制时不会经过 backlog_cost）
+        self._backlogs = [other for other in self._backlogs if other.remaining]
+        self._backlogs.append(backlog)
+        return backlog
+
+    def position(self, job_id: str) -> Optional[Tuple[int, Optional[float]]]:
+        """查询排队中的请求前面还有多少请求，以及预计等待时间（秒）"""
+        job = self._jobs.get(job_id)
+        if job is None or not job.waiting:
+            return None
+        ahead = [
+            other
+            for priority, queue in self._queues.items()
+            if priority <= job.priority
+            for other in queue.heap
+            if other.waiting and (priority < job.priority or other < job)
+        ]
+        estimated_wait = None
+        if self.seconds_per_cost is not None:
+            backlog = self.active_cost + job.cost + sum(other.cost for other in ahead)
+            estimated_wait = round(backlog * self.seconds_per_cost / self.capacity, 2)
+        return len(ahead), estimated_wait
+
+    def stats(self) -> Dict[str, object]:
+        """调度器状态"""
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": {
+                priority.name.lower(): sum(1 for job in queue.heap if job.waiting)
+                for priority, queue in self._queues.items()
+            },
+            "backlog": sum(backlog.remaining for backlog in self._backlogs),
+            "estimated_drain_time": round(self.estimate_drain_time(Priority.BATCH) or 0.0, 2),
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+    async def _acquire(self, cost: float):
+        context = current_job.get()
+        job = self._enqueue(context, context.priority, cost, time.time())
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            # 已分配槽位但在恢复执行前被取消：归还槽位
+            if job.future.done() and not job.future.cancelled() and job.future.exception() is None:
+                self._release(cost, None)
+            raise
+        finally:
+            if job.timer is not None:
+                job.timer.cancel()
+            # 降级后登记的是新条目，它与原条目共享同一个 future
+            tracked = self._jobs.get(context.job_id) if context.job_id else None
+            if tracked is not None and tracked.future is job.future:
+                del self._jobs[context.job_id]
+
+    def _enqueue(
+        self,
+        context: JobContext,
+        priority: Priority,
+        cost: float,
+        enqueued_at: float,
+        future: Optional[asyncio.Future] = None
+    ) -> _Job:
+        queue = self._queues[priority]
+        start, finish = queue.tags(context.client_id, cost, self.client_weights.get(context.client_id, 1.0))
+        loop = asyncio.get_running_loop()
+        job = _Job(
+            finish=finish,
+            seq=next(self._seq),
+            start=start,
+            priority=priority,
+            context=context,
+            cost=cost,
+            enqueued_at=enqueued_at,
+            future=future or loop.create_future()
+        )
+        if context.deadline is not None:
+            job.timer = loop.call_at(
+                loop.time() + max(0.0, context.deadline - time.time()), self._on_deadline, job
+            )
+        queue.push(job)
+        if context.job_id:
+            self._jobs[context.job_id] = job
+        self._dispatch()
+        return job
+
+    def _on_deadline(self, job: _Job):
+        """排队中的请求到达截止时间：丢弃或降为 batch 优先级"""
+        if not job.waiting:
+            return
+        waited = time.time() - job.enqueued_at
+        if self.deadline_policy == "demote":
+            if job.priority != Priority.BATCH:
+                logger.info(f"请求超过截止时间，降为 batch | client: {job.context.client_id} | 排队 {waited:.1f}s")
+                job.superseded = True
+                self._enqueue(
+                    replace(job.context, deadline=None), Priority.BATCH, job.cost, job.enqueued_at, job.future
+                )
+            return
+
+        logger.warning(f"请求超过截止时间，已丢弃 | client: {job.context.client_id} | 排队 {waited:.1f}s")
+        self.dropped += 1
+        job.future.set_exception(DeadlineExceeded(waited))
+
+    def _dispatch(self):
+        while self.active < self.capacity:
+            for priority in Priority:
+                job = self._queues[priority].pop()
+                if job is not None:
+                    break
+            else:
+                return
+            self.active += 1
+            self.active_cost += job.cost
+            job.future.set_result(None)
+
+    def _release(self, cost: float, service_time: Optional[float]):
+        self.active -= 1
+        self.active_cost = max(0.0, self.active_cost - cost)
+        if service_time is not None and cost > 0:
+            sample = service_time / cost
+            if self.seconds_per_cost is None:
+                self.seconds_per_cost = sample
+            else:
+                self.seconds_per_cost += SERVICE_TIME_SMOOTHING * (sample - self.seconds_per_cost)
+        self._dispatch()
+
+
+# 全局调度器
+ocr_scheduler = OCRScheduler(
+    SCHEDULER_CAPACITY, DEADLINE_POLICY, parse_client_weights(CLIENT_WEIGHTS), MAX_QUEUE_SECONDS
+)
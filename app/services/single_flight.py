@@ -0,0 +1,61 @@
+"""
+相同请求合并（single-flight）
+
+同一键的请求在执行期间只运行一次：第一个请求启动任务，之后到达的相同请求等待同一个任务的结果。
+与结果缓存互补：缓存只对已完成的结果生效，合并消除突发时同时在途的重复 GPU 推理。
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """一个在途任务及其等待者计数"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """按键合并在途的协程调用"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行 fn 并返回结果；若相同 key 的调用正在进行，则等待其结果
+
+        - 单个等待者被取消不影响其他等待者（共享任务由 asyncio.shield 保护）
+        - 所有等待者都取消后才取消共享任务
+        - 共享任务抛出的异常会传递给所有等待者
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _, flight=flight: self._forget(key, flight))
+        else:
+            self.coalesced += 1
+            logger.info(f"合并相同请求 | key: {key[:16]} | 等待者: {flight.waiters + 1}")
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # 已无等待者：取消共享任务，并立即移除，之后到达的请求重新执行
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def in_flight(self) -> int:
+        """当前在途的不同请求数"""
+        return len(self._flights)
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,415 @@
+"""
+任务注册表
+
+保存 /api/ocr 异步任务的状态：
+
+- 已结束的任务在 OCR_TASK_TTL 后淘汰（未结束的任务按创建时间计算，避免中断的任务永久残留）；
+  任务数超过 OCR_TASK_MAX_TASKS 时优先淘汰最早创建的已结束任务
+- 按状态与创建时间建立索引，列表支持状态 / 创建时间过滤与游标分页（按创建时间倒序）
+- 序列化后超过 OCR_TASK_RESULT_INLINE_BYTES 的结果写入磁盘，只在查询单个任务时读取
+- memory 后端保存在进程内；sqlite 后端保存在 OCR_DATA_DIR/tasks.db，重启后仍可查询，
+  多个 worker 可共享
+- 状态变化时唤醒等待该任务的长轮询 / SSE 请求；sqlite 后端另按 OCR_TASK_WATCH_INTERVAL
+  重新查询，以感知其他 worker 的更新
+"""
+import json
+import time
+import bisect
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.models.schemas import TaskStatus
+from app.core.config import (
+    TASK_BACKEND, DATA_DIR, TASK_TTL, TASK_MAX_TASKS, TASK_RESULT_INLINE_BYTES, TASK_WATCH_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+# 已结束的任务状态
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+# 过期任务清理的最小间隔（秒）
+SWEEP_INTERVAL = 60
+
+# 列表排序键：(创建时间, 任务ID)
+TaskKey = Tuple[float, str]
+
+
+def encode_cursor(key: TaskKey) -> str:
+    """将列表中最后一项的排序键编码为游标"""
+    created_at, task_id = key
+    return f"{created_at!r}_{task_id}"
+
+
+def decode_cursor(cursor: str) -> TaskKey:
+    """解析游标，格式无效时抛出 ValueError"""
+    created_at, sep, task_id = cursor.partition("_")
+    if not sep or not task_id:
+        raise ValueError(f"无效的游标: {cursor}")
+    return float(created_at), task_id
+
+
+class _Watch:
+    """等待同一任务状态变化的请求共享的事件及其等待者计数"""
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.waiters = 0
+
+
+class TaskRegistry(ABC):
+    """任务注册表基类：负责结果落盘与读取、状态变化通知，存储与索引由子类实现"""
+
+    # 重新查询任务的间隔（秒），None 表示只依赖本进程内的状态变化通知
+    watch_interval: Optional[float] = None
+
+    def __init__(self, result_dir: Path, ttl: int, max_tasks: int, inline_bytes: int):
+        self.result_dir = result_dir
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self.inline_bytes = inline_bytes
+        self._last_sweep = 0.0
+        self._watches: Dict[str, _Watch] = {}
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+        self._sweep_result_files()
+
+    @abstractmethod
+    async def create(self, task: TaskStatus):
+        """登记新任务，并按需淘汰过期 / 超量的任务"""
+
+    @abstractmethod
+    async def get(self, task_id: str) -> Optional[TaskStatus]:
+        """获取任务（含完整结果），不存在或已淘汰时返回 None"""
+
+    @abstractmethod
+    async def update(self, task_id: str, **changes: Any):
+        """更新任务字段；任务已被淘汰时忽略"""
+
+    @abstractmethod
+    async def list(
+        self,
+        status: Optional[str] = None,
+        created_after: Optional[float] = None,
+        cursor: Optional[str] = None,
+        limit: int = 50
+    ) -> Tuple[List[TaskStatus], Optional[str]]:
+        """按创建时间倒序列出任务元数据（不含结果），返回 (任务列表, 下一页游标)"""
+
+    async def wait_for_change(self, task_id: str, status: str, timeout: float) -> Optional[TaskStatus]:
+        """等待任务状态不再是 status，最多等待 timeout 秒，返回最新的任务（不存在时返回 None）"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            # 先登记再查询，查询期间发生的状态变化不会丢失
+            watch = self._watches.setdefault(task_id, _Watch())
+            watch.waiters += 1
+            try:
+                task = await self.get(task_id)
+                remaining = deadline - loop.time()
+                if task is None or task.status != status or remaining <= 0:
+                    return task
+                if self.watch_interval is not None:
+                    remaining = min(remaining, self.watch_interval)
+                try:
+                    await asyncio.wait_for(watch.event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                watch.waiters -= 1
+                if watch.waiters == 0 and self._watches.get(task_id) is watch:
+                    del self._watches[task_id]
+
+    def _notify(self, task_id: str):
+        """唤醒等待该任务状态变化的请求"""
+        watch = self._watches.pop(task_id, None)
+        if watch is not None:
+            watch.event.set()
+
+    def _offload_result(
+        self, task_id: str, result: Optional[Dict[str, Any]]
+    ) -> Tuple[Optional[str], Optional[Path]]:
+        """序列化结果；超过阈值时写入磁盘，返回 (内联 JSON, 结果文件路径)"""
+        if result is None:
+            return None, None
+        data = json.dumps(result, ensure_ascii=False)
+        if len(data.encode("utf-8")) <= self.inline_bytes:
+            return data, None
+        path = self.result_dir / f"{task_id}.json"
+        path.write_text(data, encoding="utf-8")
+        return None, path
+
+    @staticmethod
+    def _load_result(data: Optional[str], path: Optional[Path]) -> Optional[Dict[str, Any]]:
+        """读取内联或落盘的结果"""
+        if data is not None:
+            return json.loads(data)
+        if path is not None:
+            try:
+                return json.loads(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                logger.warning(f"任务结果文件不存在: {path}")
+        return None
+
+    def _sweep_result_files(self):
+        """删除超过 TTL 的结果文件（包括上次运行遗留的文件）"""
+        deadline = time.time() - self.ttl
+        for path in self.result_dir.glob("*.json"):
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+            except OSError:
+                continue
+
+    def _is_expired(self, task: TaskStatus, now: float) -> bool:
+        if task.status in FINISHED_STATUSES:
+            return (task.completed_at or task.created_at) < now - self.ttl
+        return task.created_at < now - self.ttl
+
+
+class MemoryTaskRegistry(TaskRegistry):
+    """进程内任务注册表：结果较大时落盘，内存中只保留元数据"""
+
+    def __init__(self, result_dir: Path, ttl: int, max_tasks: int, inline_bytes: int):
+        super().__init__(result_dir, ttl, max_tasks, inline_bytes)
+        self._tasks: Dict[str, TaskStatus] = {}
+        self._result_paths: Dict[str, Path] = {}
+        self._order: List[TaskKey] = []
+        self._by_status: Dict[str, List[TaskKey]] = {}
+
+    async def create(self, task: TaskStatus):
+        key = (task.created_at, task.task_id)
+        self._tasks[task.task_id] = task
+        bisect.insort(self._order, key)
+        bisect.insort(self._by_status.setdefault(task.status, []), key)
+        self._evict()
+
+    async def get(self, task_id: str) -> Optional[TaskStatus]:
+        task = self._tasks.get(task_id)
+        if task is None:
+            return None
+        path = self._result_paths.get(task_id)
+        if path is None:
+            return task.model_copy()
+        result = await asyncio.to_thread(self._load_result, None, path)
+        return task.model_copy(update={"result": result})
+
+    async def update(self, task_id: str, **changes: Any):
+        task = self._tasks.get(task_id)
+        if task is None:
+            return
+        if "result" in changes:
+            _, path = await asyncio.to_thread(self._offload_result, task_id, changes["result"])
+            if path is not None:
+                self._result_paths[task_id] = path
+                changes["result"] = None
+            else:
+                self._result_paths.pop(task_id, None)
+        status = changes.get("status")
+        if status is not None and status != task.status:
+            key = (task.created_at, task_id)
+            self._remove_key(self._by_status.get(task.status, []), key)
+            bisect.insort(self._by_status.setdefault(status, []), key)
+        for field, value in changes.items():
+            setattr(task, field, value)
+        if status is not None:
+            self._notify(task_id)
+
+    async def list(self, status=None, created_after=None, cursor=None, limit=50):
+        keys = self._by_status.get(status, []) if status else self._order
+        end = bisect.bisect_left(keys, decode_cursor(cursor)) if cursor else len(keys)
+        start = bisect.bisect_right(keys, (created_after, "\uffff")) if created_after is not None else 0
+
+        page_keys = keys[max(start, end - limit):end][::-1]
+        tasks = [self._tasks[task_id].model_copy(update={"result": None}) for _, task_id in page_keys]
+        next_cursor = encode_cursor(page_keys[-1]) if page_keys and end - limit > start else None
+        return tasks, next_cursor
+
+    def _evict(self):
+        now = time.time()
+        if now - self._last_sweep >= SWEEP_INTERVAL:
+            self._last_sweep = now
+            expired = [task_id for task_id, task in self._tasks.items() if self._is_expired(task, now)]
+            for task_id in expired:
+                self._remove(task_id)
+            if expired:
+                logger.info(f"淘汰过期任务 {len(expired)} 个")
+
+        if len(self._tasks) > self.max_tasks:
+            for _, task_id in list(self._order):
+                if len(self._tasks) <= self.max_tasks:
+                    break
+                if self._tasks[task_id].status in FINISHED_STATUSES:
+                    self._remove(task_id)
+
+    def _remove(self, task_id: str):
+        task = self._tasks.pop(task_id)
+        key = (task.created_at, task_id)
+        self._remove_key(self._order, key)
+        self._remove_key(self._by_status.get(task.status, []), key)
+        path = self._result_paths.pop(task_id, None)
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _remove_key(keys: List[TaskKey], key: TaskKey):
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+
+class SQLiteTaskRegistry(TaskRegistry):
+    """基于 SQLite 的任务注册表，数据库操作在线程中执行"""
+
+    watch_interval = TASK_WATCH_INTERVAL
+
+    COLUMNS = ("task_id", "status", "created_at", "completed_at", "error", "result", "result_path", "timings")
+
+    def __init__(self, db_path: Path, result_dir: Path, ttl: int, max_tasks: int, inline_bytes: int):
+        super().__init__(result_dir, ttl, max_tasks, inline_bytes)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL, "
+                "completed_at REAL, error TEXT, result TEXT, result_path TEXT, timings TEXT)"
+            )
+            # 兼容旧版本创建的数据库
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+            if "timings" not in columns:
+                self._conn.execute("ALTER TABLE tasks ADD COLUMN timings TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at, task_id)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at, task_id)"
+            )
+        logger.info(f"任务注册表使用 SQLite: {db_path}")
+
+    async def create(self, task: TaskStatus):
+        data, path = self._offload_result(task.task_id, task.result) if task.result else (None, None)
+        await asyncio.to_thread(
+            self._execute,
+            f"INSERT OR REPLACE INTO tasks ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (task.task_id, task.status, task.created_at, task.completed_at, task.error,
+             data, str(path) if path else None, json.dumps(task.timings) if task.timings else None)
+        )
+        now = time.time()
+        sweep_expired = now - self._last_sweep >= SWEEP_INTERVAL
+        if sweep_expired:
+            self._last_sweep = now
+        await asyncio.to_thread(self._evict, now, sweep_expired)
+
+    async def get(self, task_id: str) -> Optional[TaskStatus]:
+        rows = await asyncio.to_thread(
+            self._execute, f"SELECT {', '.join(self.COLUMNS)} FROM tasks WHERE task_id = ?", (task_id,)
+        )
+        if not rows:
+            return None
+        return await asyncio.to_thread(self._row_to_task, rows[0], True)
+
+    async def update(self, task_id: str, **changes: Any):
+        if "result" in changes:
+            data, path = await asyncio.to_thread(self._offload_result, task_id, changes.pop("result"))
+            changes["result"] = data
+            changes["result_path"] = str(path) if path else None
+        if "timings" in changes:
+            changes["timings"] = json.dumps(changes["timings"]) if changes["timings"] else None
+        assignments = ", ".join(f"{field} = ?" for field in changes if field in self.COLUMNS)
+        values = [value for field, value in changes.items() if field in self.COLUMNS]
+        if assignments:
+            await asyncio.to_thread(
+                self._execute, f"UPDATE tasks SET {assignments} WHERE task_id = ?", (*values, task_id)
+            )
+        if "status" in changes:
+            self._notify(task_id)
+
+    async def list(self, status=None, created_after=None, cursor=None, limit=50):
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if created_after is not None:
+            conditions.append("created_at > ?")
+            params.append(created_after)
+        if cursor:
+            conditions.append("(created_at, task_id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = await asyncio.to_thread(
+            self._execute,
+            f"SELECT {', '.join(self.COLUMNS)} FROM tasks {where} "
+            f"ORDER BY created_at DESC, task_id DESC LIMIT ?",
+            (*params, limit + 1)
+        )
+        tasks = [self._row_to_task(row, False) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = tasks[-1]
+            next_cursor = encode_cursor((last.created_at, last.task_id))
+        return tasks, next_cursor
+
+    def _execute(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _row_to_task(self, row: tuple, with_result: bool) -> TaskStatus:
+        task_id, status, created_at, completed_at, error, data, result_path, timings = row
+        result = self._load_result(data, Path(result_path) if result_path else None) if with_result else None
+        return TaskStatus(
+            task_id=task_id,
+            status=status,
+            result=result,
+            error=error,
+            created_at=created_at,
+            completed_at=completed_at,
+            timings=json.loads(timings) if timings else None
+        )
+
+    def _evict(self, now: float, sweep_expired: bool):
+        finished = ", ".join("?" * len(FINISHED_STATUSES))
+        expired = []
+        if sweep_expired:
+            deadline = now - self.ttl
+            expired = self._execute(
+                f"SELECT task_id, result_path FROM tasks WHERE "
+                f"(status IN ({finished}) AND COALESCE(completed_at, created_at) < ?) "
+                f"OR (status NOT IN ({finished}) AND created_at < ?)",
+                (*FINISHED_STATUSES, deadline, *FINISHED_STATUSES, deadline)
+            )
+        count = self._execute("SELECT COUNT(*) FROM tasks")[0][0]
+        overflow = count - len(expired) - self.max_tasks
+        if overflow > 0:
+            expired_ids = {task_id for task_id, _ in expired}
+            oldest = self._execute(
+                f"SELECT task_id, result_path FROM tasks WHERE status IN ({finished}) "
+                f"ORDER BY created_at, task_id LIMIT ?",
+                (*FINISHED_STATUSES, overflow + len(expired))
+            )
+            expired += [row for row in oldest if row[0] not in expired_ids][:overflow]
+
+        for task_id, result_path in expired:
+            self._execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+            if result_path:
+                Path(result_path).unlink(missing_ok=True)
+        if expired:
+            logger.info(f"淘汰过期 / 超量任务 {len(expired)} 个")
+
+
+def create_task_registry() -> TaskRegistry:
+    """根据 OCR_TASK_BACKEND 创建任务注册表"""
+    result_dir = DATA_DIR / "task_results"
+    if TASK_BACKEND == "sqlite":
+        return SQLiteTaskRegistry(
+            DATA_DIR / "tasks.db", result_dir, TASK_TTL, TASK_MAX_TASKS, TASK_RESULT_INLINE_BYTES
+        )
+    return MemoryTaskRegistry(result_dir, TASK_TTL, TASK_MAX_TASKS, TASK_RESULT_INLINE_BYTES)
+
+
+# 全局任务注册表
+task_registry = create_task_registry()
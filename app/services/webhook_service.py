@@ -0,0 +1,211 @@
+"""
+任务完成回调（webhook）
+
+/api/ocr 任务结束（completed / failed / cancelled）后，将任务状态以 JSON POST 到调用方提供的 callback_url：
+
+- 非 2xx 响应或网络错误时按指数退避重试，最多 OCR_WEBHOOK_MAX_RETRIES 次；
+  除 408 / 429 外的 4xx 视为调用方拒绝，不再重试
+- 设置 OCR_WEBHOOK_SECRET 时，请求头 X-OCR-Signature 为请求体的 HMAC-SHA256 签名（sha256=<hex>）
+- 防止 SSRF：回调地址解析出的 IP 为回环 / 链路本地 / 私有等非公网地址时拒绝，
+  除非主机名或地址在 OCR_WEBHOOK_ALLOWED_HOSTS 中；连接时对实际连接的地址再次检查（避免 DNS 重绑定），
+  不跟随重定向，不使用环境变量中的代理
+- 投递在后台进行，不阻塞任务处理；服务重启时尚未投递成功的回调会丢失
+"""
+import hmac
+import json
+import socket
+import random
+import asyncio
+import hashlib
+import logging
+import ipaddress
+import http.client
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Set, Tuple, Union
+from urllib.parse import urlparse
+
+from app.core.config import (
+    WEBHOOK_MAX_RETRIES, WEBHOOK_BACKOFF, WEBHOOK_TIMEOUT, WEBHOOK_SECRET, WEBHOOK_ALLOWED_HOSTS
+)
+
+logger = logging.getLogger(__name__)
+
+# 进行中的投递任务（保留引用，避免被垃圾回收）
+_deliveries: Set[asyncio.Task] = set()
+
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def parse_allowed_hosts(spec: str) -> Tuple[Set[str], List[IPNetwork]]:
+    """解析回调地址白名单，返回 (主机名集合, 网段列表)；单个 IP 视为只含该地址的网段"""
+    hostnames, networks = set(), []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            hostnames.add(item.rstrip("."))
+    return hostnames, networks
+
+
+_allowed_hostnames, _allowed_networks = parse_allowed_hosts(WEBHOOK_ALLOWED_HOSTS)
+
+
+def _is_public(address: str) -> bool:
+    """地址是否为公网地址（IPv4 映射的 IPv6 地址按其 IPv4 地址判断）"""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _check_address(address: str):
+    """非公网且不在白名单网段中的地址抛出 ValueError"""
+    if _is_public(address):
+        return
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if any(ip in network for network in _allowed_networks):
+        return
+    raise ValueError(f"回调地址指向内网地址 {address}，如需允许请配置 OCR_WEBHOOK_ALLOWED_HOSTS")
+
+
+def _resolve_callback_host(host: str, port: int) -> List[tuple]:
+    """解析回调主机并检查全部地址，返回 getaddrinfo 的结果；白名单中的主机名不检查地址"""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"无法解析回调地址的主机 {host}: {e}")
+    if host.lower().rstrip(".") not in _allowed_hostnames:
+        # 任一地址不允许即拒绝，避免混合记录绕过检查
+        for *_, sockaddr in infos:
+            _check_address(sockaddr[0])
+    return infos
+
+
+def validate_callback_url(url: str):
+    """校验回调地址：只接受 http / https，且主机解析后的地址须为公网或在白名单中，不合法时抛出 ValueError
+
+    会进行 DNS 解析，在异步代码中应在线程中调用。
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"无效的回调地址: {url}")
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        raise ValueError(f"无效的回调地址: {url}")
+    _resolve_callback_host(parsed.hostname, port)
+
+
+def _create_checked_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection 的替代：只连接通过检查的地址（检查与连接使用同一次解析结果）"""
+    host, port = address
+    last_error = None
+    for family, socktype, proto, _, sockaddr in _resolve_callback_host(host, port):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            last_error = e
+    raise last_error or OSError(f"无法连接回调地址 {host}:{port}")
+
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_checked_connection
+
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_checked_connection
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """不跟随重定向：3xx 响应以 HTTPError 返回"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+# 不使用环境变量中的代理（代理会绕过地址检查），不跟随重定向
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _CheckedHTTPHandler(), _CheckedHTTPSHandler(), _NoRedirectHandler()
+)
+
+
+def _post_json(url: str, body: bytes, timeout: float) -> int:
+    """同步发送 POST 请求，返回 HTTP 状态码（在线程中调用）
+
+    连接的地址不允许时抛出 ValueError。
+    """
+    headers = {"Content-Type": "application/json", "User-Agent": "deepseek-ocr-fastapi"}
+    if WEBHOOK_SECRET:
+        signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers["X-OCR-Signature"] = f"sha256={signature}"
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with _opener.open(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+async def deliver_webhook(url: str, payload: Dict[str, Any]) -> bool:
+    """投递回调，失败时按指数退避重试，返回是否投递成功"""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    task_id = payload.get("task_id")
+    for attempt in range(WEBHOOK_MAX_RETRIES + 1):
+        try:
+            status = await asyncio.to_thread(_post_json, url, body, WEBHOOK_TIMEOUT)
+        except ValueError as e:
+            # 地址不允许（如 DNS 记录已改为内网地址），重试无意义
+            logger.error(f"回调投递放弃 | 任务: {task_id} | {e}")
+            return False
+        except Exception as e:
+            logger.warning(f"回调投递失败 | 任务: {task_id} | 第 {attempt + 1} 次 | {e}")
+        else:
+            if 200 <= status < 300:
+                logger.info(f"回调投递成功 | 任务: {task_id} | {url}")
+                return True
+            logger.warning(f"回调投递失败 | 任务: {task_id} | 第 {attempt + 1} 次 | HTTP {status}")
+            if 300 <= status < 400:
+                logger.error(f"回调投递放弃 | 任务: {task_id} | 回调地址返回重定向，不跟随")
+                return False
+            if 400 <= status < 500 and status not in (408, 429):
+                return False
+
+        if attempt < WEBHOOK_MAX_RETRIES:
+            # 指数退避并加入随机抖动，避免大量回调同时重试
+            await asyncio.sleep(WEBHOOK_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    logger.error(f"回调投递放弃 | 任务: {task_id} | {url}")
+    return False
+
+
+def schedule_webhook(url: str, payload: Dict[str, Any]):
+    """在后台投递回调"""
+    delivery = asyncio.create_task(deliver_webhook(url, payload))
+    _deliveries.add(delivery)
+    delivery.add_done_callback(_deliveries.discard)
@@ -0,0 +1,48 @@
+"""
+客户端断开连接检测
+
+同步接口在识别期间监听客户端连接，客户端放弃请求后取消识别：
+调度器中的排队条目随之移除，已提交给引擎的请求随之中止，不再为无人接收的结果解码。
+流式接口由 StreamingResponse 在断开时取消生成器，不需要额外处理。
+"""
+import asyncio
+import logging
+from typing import Awaitable, TypeVar
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 客户端已断开连接（沿用 nginx 的 499 状态码，仅出现在访问日志中）
+CLIENT_CLOSED_REQUEST = 499
+
+
+async def _wait_for_disconnect(request: Request):
+    """等待 http.disconnect 消息（请求体已读取完毕，之后只会收到断开消息）
+
+    不使用 request.is_disconnected()：经过 BaseHTTPMiddleware 包装后，
+    它的零超时检查到达不了服务器，永远返回 False。
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_until_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """等待 awaitable 完成并返回结果；客户端先断开连接时取消它并抛出 499"""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        logger.info(f"客户端已断开连接，取消识别 | {request.method} {request.url.path}")
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="客户端已断开连接")
+    finally:
+        for pending in (task, watcher):
+            if not pending.done():
+                pending.cancel()
+        await asyncio.gather(task, watcher, return_exceptions=True)
@@ -2,12 +2,12 @@
 图片处理工具函数
 """
 import re
-from typing import List, Tuple, Optional
+from typing import BinaryIO, List, Tuple, Optional, Union
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 
-from app.core.config import RESOLUTION_CONFIGS
+from app.core.config import RESOLUTION_CONFIGS, MAX_IMAGE_PIXELS
 
 
 def load_image(image_path: Path) -> Optional[Image.Image]:
@@ -21,6 +21,74 @@ def load_image(image_path: Path) -> Optional[Image.Image]:
         return None
 
 
+def check_image_pixels(image: Image.Image):
+    """解码像素前检查图片尺寸（Image.open 只读取图片头），超过 MAX_IMAGE_PIXELS 时抛出 ValueError"""
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"图片尺寸 {width}x{height} 超过像素数上限 {MAX_IMAGE_PIXELS}")
+
+
+def read_image_size(source: Union[Path, BinaryIO]) -> Tuple[int, int]:
+    """只读取图片头获取 (宽, 高)，按 EXIF 方向校正（不解码像素）；像素数超过上限时抛出 ValueError
+
+    source 为文件对象时读取后回到开头（PIL 不会关闭调用方传入的文件对象）。
+    """
+    with Image.open(source) as image:
+        check_image_pixels(image)
+        width, height = image.size
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    if not isinstance(source, Path):
+        source.seek(0)
+    return width, height
+
+
+# 原始像素格式 -> (PIL raw 解码模式, 每像素字节数)
+# 带 alpha 的格式在解码时直接丢弃 alpha 通道
+PIXEL_FORMATS = {
+    "rgb": ("RGB", 3),
+    "bgr": ("BGR", 3),
+    "rgba": ("RGBX", 4),
+    "rgbx": ("RGBX", 4),
+    "bgra": ("BGRX", 4),
+    "bgrx": ("BGRX", 4),
+    "gray": ("L", 1),
+}
+
+
+def image_from_raw_pixels(
+    buffer,
+    width: int,
+    height: int,
+    pixel_format: str = "rgb",
+    row_stride: Optional[int] = None
+) -> Image.Image:
+    """将原始 uint8 像素缓冲区解码为 RGB 图片
+
+    直接由 PIL raw 解码器读取调用方的缓冲区（bytes / bytearray / memoryview / mmap），
+    通道重排、行填充跳过与 alpha 丢弃在同一遍解码中完成，不产生中间副本。
+    """
+    pixel_format = (pixel_format or "rgb").lower()
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError(f"不支持的像素格式: {pixel_format}，可选: {', '.join(PIXEL_FORMATS)}")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"无效的图片尺寸: {width}x{height}")
+
+    rawmode, channels = PIXEL_FORMATS[pixel_format]
+    row_bytes = width * channels
+    row_stride = row_stride or row_bytes
+    if row_stride < row_bytes:
+        raise ValueError(f"行跨度 {row_stride} 小于单行像素字节数 {row_bytes}")
+
+    expected = row_stride * (height - 1) + row_bytes
+    if len(buffer) < expected:
+        raise ValueError(f"像素数据长度不足: 需要至少 {expected} 字节，实际 {len(buffer)} 字节")
+
+    if rawmode == "L":
+        return Image.frombytes("L", (width, height), buffer, "raw", "L", row_stride, 1).convert("RGB")
+    return Image.frombytes("RGB", (width, height), buffer, "raw", rawmode, row_stride, 1)
+
+
 def re_match(text: str):
     """解析OCR结果中的边界框信息"""
     pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
@@ -0,0 +1,63 @@
+"""
+流式响应工具函数
+"""
+import json
+import time
+import logging
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from app.models.schemas import OCRUploadResponse
+
+logger = logging.getLogger(__name__)
+
+# 流式响应的媒体类型
+SSE_MEDIA_TYPE = "text/event-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 禁止代理缓冲，保证增量内容及时送达客户端
+STREAMING_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def format_sse(data: Any, event: Optional[str] = None) -> str:
+    """将数据编码为一条 Server-Sent Events 消息（json.dumps 输出不含换行，占一行 data）"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def format_ndjson(data: Any) -> str:
+    """将数据编码为一行 NDJSON"""
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+async def ocr_sse_events(
+    events: AsyncIterator[Tuple[str, Any]],
+    image_size: Dict[str, int],
+    start_time: float
+) -> AsyncIterator[str]:
+    """将 stream_deepseek_on_pil 产出的事件转换为 SSE 消息
+
+    - delta: {"text": 新增文本}
+    - result: 与同步接口一致的 OCRUploadResponse
+    - error: {"detail": 错误信息}
+    """
+    try:
+        async for event, payload in events:
+            if event == "delta":
+                yield format_sse({"text": payload}, event="delta")
+            elif event == "result":
+                text, processed_text, results = payload
+                response = OCRUploadResponse(
+                    success=True,
+                    results=results,
+                    processing_time=round(time.time() - start_time, 4),
+                    image_size=image_size,
+                    text=text,
+                    processed_text=processed_text
+                )
+                yield format_sse(response.model_dump(), event="result")
+    except Exception as e:
+        logger.exception(f"Streaming OCR error: {e}")
+        yield format_sse({"detail": str(e)}, event="error")
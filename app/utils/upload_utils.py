@@ -0,0 +1,111 @@
+"""
+上传文件处理工具函数
+
+所有上传均按 UPLOAD_CHUNK_SIZE 分块读取，超过大小限制立即以 413 拒绝，
+解码器拿到的是文件对象 / 磁盘路径 / 内存映射视图，而不是整个请求体的 bytes 副本。
+"""
+import os
+import mmap
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from fastapi import HTTPException, Request, UploadFile
+
+from app.core.config import UPLOAD_DIR, UPLOAD_CHUNK_SIZE
+
+
+def _too_large(max_size: int, filename: Optional[str] = None) -> HTTPException:
+    """构造 413 异常"""
+    target = f"文件 {filename} " if filename else "请求体"
+    return HTTPException(status_code=413, detail=f"{target}超过大小限制 {max_size} 字节")
+
+
+def check_upload_size(upload: UploadFile, max_size: int):
+    """根据 multipart 解析时记录的大小校验（此时文件已由解析器落盘），超限直接拒绝
+
+    单文件上传路由在接收请求体时已由 RequestSizeLimitMiddleware 按路由上限拒绝，
+    这里负责精确的单文件限制，以及批量接口中每个文件的限制。
+    """
+    if upload.size is not None and upload.size > max_size:
+        raise _too_large(max_size, upload.filename)
+
+
+async def save_upload(upload: UploadFile, destination: Path, max_size: int) -> int:
+    """将上传文件分块写入 destination，超过 max_size 时删除已写入部分并返回 413
+
+    Returns:
+        写入的字节数
+    """
+    check_upload_size(upload, max_size)
+    written = 0
+    try:
+        with open(destination, "wb") as buffer:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > max_size:
+                    raise _too_large(max_size, upload.filename)
+                buffer.write(chunk)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    return written
+
+
+async def spool_upload(upload: UploadFile, max_size: int, suffix: str = "") -> Path:
+    """将上传文件分块落盘到 UPLOAD_DIR 下的临时文件，返回其路径（由调用方负责删除）
+
+    适用于只接受文件路径、需要按需随机读取的解码器（如 PyMuPDF）。
+    """
+    fd, name = tempfile.mkstemp(suffix=suffix, dir=UPLOAD_DIR)
+    os.close(fd)
+    path = Path(name)
+    await save_upload(upload, path, max_size)
+    return path
+
+
+@contextmanager
+def mapped_upload(upload: UploadFile, max_size: int) -> Iterator[mmap.mmap]:
+    """以只读内存映射的方式访问上传文件内容，不复制到 Python bytes
+
+    multipart 解析得到的 SpooledTemporaryFile 在调用 fileno() 时会落盘。
+    """
+    check_upload_size(upload, max_size)
+    fileno = upload.file.fileno()
+    if os.fstat(fileno).st_size == 0:
+        raise ValueError("上传文件为空")
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as buffer:
+        yield buffer
+
+
+async def read_request_body(request: Request, max_size: int) -> bytearray:
+    """分块读取原始请求体到单个缓冲区，超过 max_size 立即返回 413
+
+    已知 Content-Length 时预先分配缓冲区并原地填充，避免分块拼接产生的额外副本。
+    """
+    content_length = request.headers.get("content-length")
+    if not (content_length and content_length.isdigit()):
+        body = bytearray()
+        async for chunk in request.stream():
+            if len(body) + len(chunk) > max_size:
+                raise _too_large(max_size)
+            body += chunk
+        return body
+
+    expected = int(content_length)
+    if expected > max_size:
+        raise _too_large(max_size)
+
+    body = bytearray(expected)
+    received = 0
+    with memoryview(body) as view:
+        async for chunk in request.stream():
+            end = received + len(chunk)
+            if end > expected:
+                raise HTTPException(status_code=400, detail="请求体长度与 Content-Length 不一致")
+            view[received:end] = chunk
+            received = end
+    if received != expected:
+        raise HTTPException(status_code=400, detail="请求体长度与 Content-Length 不一致")
+    return body
@@ -0,0 +1,185 @@
+"""
+CPU tests for the crop / no-crop branches of DeepseekOCRForCausalLM's vision path.
+
+deepseek_ocr.py cannot be imported without vLLM (and its config module loads the tokenizer
+from MODEL_PATH at import time), so the methods under test are compiled from the source file
+and bound to a small stand-in model whose SAM / CLIP / projector are cheap stub modules.
+"""
+import ast
+import types
+import typing
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+F = torch.nn.functional
+
+MODEL_FILE = Path(__file__).resolve().parents[1] / "DeepSeek-OCR-vllm" / "deepseek_ocr.py"
+METHODS = (
+    "_parse_and_validate_image_input",
+    "_encode_views",
+    "_pixel_values_to_embedding",
+    "_process_image_input",
+)
+
+BASE_SIZE = 128  # global view
+TILE_SIZE = 64  # local tile
+PATCH = 16  # stub encoder stride: 8x8 tokens per global view, 4x4 per tile
+N_EMBED = 6
+NEWLINE = -1.0
+SEPARATOR = -2.0
+
+
+def load_methods():
+    tree = ast.parse(MODEL_FILE.read_text(encoding="utf-8"))
+    cls = next(
+        node for node in tree.body
+        if isinstance(node, ast.ClassDef) and node.name == "DeepseekOCRForCausalLM"
+    )
+    namespace = {
+        "torch": torch,
+        "nn": nn,
+        "NestedTensors": typing.Any,
+        "PRINT_NUM_VIS_TOKENS": False,
+        "ENCODER_MICRO_BATCH": 0,
+        **{name: getattr(typing, name) for name in ("List", "Optional", "Tuple", "Union")},
+    }
+    methods = {}
+    for node in cls.body:
+        if isinstance(node, ast.FunctionDef) and node.name in METHODS:
+            code = compile(ast.Module(body=[node], type_ignores=[]), str(MODEL_FILE), "exec")
+            exec(code, namespace)
+            methods[node.name] = namespace[node.name]
+    assert set(methods) == set(METHODS)
+    return methods
+
+
+class StubSam(nn.Module):
+    """[N, 3, H, W] -> [N, 3, H / PATCH, W / PATCH]: every token carries its tile's pixel value"""
+
+    def forward(self, x):
+        return F.avg_pool2d(x, PATCH)
+
+
+class StubClip(nn.Module):
+    """Reuses the SAM features as patch tokens behind a zero class token"""
+
+    def forward(self, x, patch_embeds):
+        tokens = patch_embeds.flatten(2).permute(0, 2, 1)
+        return torch.cat([torch.zeros_like(tokens[:, :1]), tokens], dim=1)
+
+
+@pytest.fixture
+def model():
+    stub = types.SimpleNamespace(
+        sam_model=StubSam(),
+        vision_model=StubClip(),
+        projector=nn.Identity(),
+        image_newline=torch.full((N_EMBED,), NEWLINE),
+        view_seperator=torch.full((N_EMBED,), SEPARATOR),
+    )
+    for name, fn in load_methods().items():
+        setattr(stub, name, types.MethodType(fn, stub))
+    return stub
+
+
+def make_image(grid, global_value=0.5):
+    """Processor-shaped inputs for one image; tile k of a multi-tile grid is filled with k + 1"""
+    width_tiles, height_tiles = grid
+    pixel_values = torch.full((1, 3, BASE_SIZE, BASE_SIZE), global_value)
+    if width_tiles > 1 or height_tiles > 1:
+        tiles = torch.arange(1, width_tiles * height_tiles + 1, dtype=torch.float32)
+        images_crop = tiles.view(1, -1, 1, 1, 1).expand(-1, -1, 3, TILE_SIZE, TILE_SIZE).clone()
+    else:
+        images_crop = torch.zeros(1, 1, 3, TILE_SIZE, TILE_SIZE)
+    return pixel_values, images_crop, torch.tensor([list(grid)])
+
+
+def expected_embedding(grid, global_value=0.5):
+    """Token layout built independently: local rows + newline, global rows + newline, separator"""
+    width_tiles, height_tiles = grid
+    rows = []
+    if width_tiles > 1 or height_tiles > 1:
+        tile_tokens = TILE_SIZE // PATCH
+        for row in range(height_tiles * tile_tokens):
+            for col in range(width_tiles * tile_tokens):
+                rows.append((row // tile_tokens) * width_tiles + col // tile_tokens + 1)
+            rows.append(NEWLINE)
+    global_tokens = BASE_SIZE // PATCH
+    for _ in range(global_tokens):
+        rows.extend([global_value] * global_tokens + [NEWLINE])
+    rows.append(SEPARATOR)
+    return torch.tensor(rows, dtype=torch.float32)[:, None].expand(-1, N_EMBED)
+
+
+def run(model, images):
+    """Batch images the way vLLM does: stacked when shapes agree, lists otherwise"""
+    def batch(items):
+        if all(item.shape == items[0].shape for item in items):
+            return torch.stack(items)
+        return list(items)
+
+    pixel_values, images_crop, spatial_crop = zip(*images)
+    image_input = model._parse_and_validate_image_input(
+        pixel_values=batch(pixel_values),
+        images_crop=batch(images_crop),
+        images_spatial_crop=batch(spatial_crop),
+    )
+    assert image_input is not None
+    return model._process_image_input(image_input)
+
+
+def test_no_crop_grid(model):
+    embeddings = run(model, [make_image((1, 1))])
+    assert len(embeddings) == 1
+    assert torch.equal(embeddings[0], expected_embedding((1, 1)))
+
+
+def test_crop_grid(model):
+    embeddings = run(model, [make_image((2, 3))])
+    assert len(embeddings) == 1
+    assert torch.equal(embeddings[0], expected_embedding((2, 3)))
+
+
+def test_mixed_batch(model):
+    grids = [(1, 1), (2, 3), (3, 1), (1, 1)]
+    images = [make_image(grid, global_value=0.25 * (index + 1)) for index, grid in enumerate(grids)]
+    embeddings = run(model, images)
+    assert len(embeddings) == len(grids)
+    for index, (grid, embedding) in enumerate(zip(grids, embeddings)):
+        assert torch.equal(embedding, expected_embedding(grid, global_value=0.25 * (index + 1)))
+
+
+def test_placeholder_returns_none(model):
+    assert model._parse_and_validate_image_input(
+        pixel_values=torch.zeros(1, 1, 3, BASE_SIZE, BASE_SIZE),
+        images_crop=torch.zeros(1, 1, 1, 3, TILE_SIZE, TILE_SIZE),
+        images_spatial_crop=torch.zeros(1, 1, 2, dtype=torch.long),
+    ) is None
+    assert model._parse_and_validate_image_input() is None
+
+
+def test_no_device_sync_on_pixels(model, monkeypatch):
+    def forbidden(*args, **kwargs):
+        raise AssertionError("crop detection must not reduce or read back pixel tensors")
+
+    tolist_calls = []
+    tolist = torch.Tensor.tolist
+
+    def counting_tolist(self):
+        tolist_calls.append(tuple(self.shape))
+        return tolist(self)
+
+    monkeypatch.setattr(torch.Tensor, "item", forbidden)
+    monkeypatch.setattr(torch, "sum", forbidden)
+    monkeypatch.setattr(torch.Tensor, "tolist", counting_tolist)
+
+    grids = [(1, 1), (2, 3), (2, 2)]
+    embeddings = run(model, [make_image(grid) for grid in grids])
+    assert [tuple(embedding.shape) for embedding in embeddings] == [
+        tuple(expected_embedding(grid).shape) for grid in grids
+    ]
+    # the only host read is the tile-grid metadata, never the pixels
+    assert tolist_calls == [(len(grids), 1, 2)]